@@ -1,44 +1,92 @@
+import collections
+import concurrent.futures
 import json
 import matplotlib.pyplot as plt
 import os
 import random
+import re
 import yaml
 import zipfile
 
 
+# Index of the events in the IG files, rebuilt only for the files whose mtime or size changed
+IG_INDEX_PATH = './igfile_index.json'
+IG_EVENT_PATTERN = re.compile(r'^Events/Run_(\d+)/Event_(\d+)$')
+
+# Source IG files kept open while the mixed sets are written
+IG_FILE_POOL_SIZE = 16
+
+
 def postmix():
 
     print("Hello World")
 
 
-def event_exists(event_list, event):
-    
-    if len(event_list) == 0:
-        return False
-    
-    exists = any([event['event']==e['event'] for e in event_list])
-    if exists:
-        # print("Skipping duplicate event: \n", event)
-        return True
-    
-    return False
+def list_ig_events(igfile):
+
+    # Only the central directory of the zip is read
+    with zipfile.ZipFile(igfile, "r") as z:
+        names = z.namelist()
+
+    ig_events = []
+    for name in names:
+        match = IG_EVENT_PATTERN.match(name)
+        if match:
+            ig_events.append([int(match[1]), int(match[2]), name])
+    return ig_events
+
+
+def load_ig_index(dfolders, index_path=IG_INDEX_PATH):
+
+    ig_index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            ig_index = json.load(f)
 
+    stale_igfiles = []
+    for dfolder in dfolders:
+        for igfile in sorted(os.listdir(dfolder)):
+            stat = os.stat(dfolder+igfile)
+            entry = ig_index.get(dfolder+igfile)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                stale_igfiles.append((dfolder+igfile, stat))
 
-def find_event_in_igfiles(event, dfolder):
-    igfiles = os.listdir(dfolder)
+    removed_igfiles = [igfile for igfile in ig_index if not os.path.exists(igfile)]
 
-    for igfile in igfiles:
+    if stale_igfiles:
+        print(f"Indexing {len(stale_igfiles)} IG files")
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            igfiles = [igfile for igfile, _ in stale_igfiles]
+            for (igfile, stat), ig_events in zip(stale_igfiles, executor.map(list_ig_events, igfiles)):
+                ig_index[igfile] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'events': ig_events}
 
-        with zipfile.ZipFile(dfolder+igfile, "r") as z:
+    if stale_igfiles or removed_igfiles:
+        for igfile in removed_igfiles:
+            del ig_index[igfile]
 
-            for eventname in z.namelist():
-                if str(event['event']) in eventname:
-                    return dfolder+igfile    
+        # Replaced in one step, so an interrupted run never leaves a truncated index
+        with open(f'{index_path}.tmp', 'w') as f:
+            json.dump(ig_index, f)
+        os.replace(f'{index_path}.tmp', index_path)
+
+    # (folder, run, event) -> (IG file, member name)
+    event_lookup = {}
+    for dfolder in dfolders:
+        for igfile in sorted(os.listdir(dfolder)):
+            for run, event, name in ig_index[dfolder+igfile]['events']:
+                event_lookup.setdefault((dfolder, run, event), (dfolder+igfile, name))
+    return event_lookup
+
+
+def find_event_in_igfiles(event, dfolder, event_lookup):
+    return event_lookup.get((dfolder, event['run'], event['event']), (None, None))
 
 
 def make_unique_events(sigsets):
 
     unique_events = []
+    unique_keys = set()
+    event_lookup = load_ig_index([sigset['igfiles'] for sigset in sigsets])
 
     for sigset in sigsets:
         json_file = sigset['json']
@@ -48,13 +96,19 @@ def make_unique_events(sigsets):
             events = json.load(f)
 
         for event in events:
-            if not event_exists(unique_events, event):
+            key = (event['run'], event['event'])
+            if key not in unique_keys:
 
-                # Find IGFile with event
-                igfilename = find_event_in_igfiles(event, dfolder)
+                # Find IGFile with event, reported here instead of in the workers writing the sets
+                igfilename, igeventname = find_event_in_igfiles(event, dfolder, event_lookup)
+                if igfilename is None:
+                    raise RuntimeError(f"Run {event['run']} event {event['event']} of {json_file} not found "
+                                       f"in the IG files of {dfolder}")
 
-                # Append filename name to event
+                # Append filename and member name to event
                 event['file'] = igfilename
+                event['member'] = igeventname
+                unique_keys.add(key)
                 unique_events.append(event)
 
     return unique_events
@@ -90,66 +144,132 @@ def make_combined_mass_plot(sevents):
 
 
 class BackgroundSet:
-    def __init__(self, fpath):
-        bkgigfilenames = os.listdir(fpath)
-        self.bkgeventnames = []
-        self.bkgevents = []
+
+    # Only the (IG file, member name) of the events are kept, an event is read when it is used
+    def __init__(self, fpath, sample=False, seed=None):
+        bkgigfilenames = sorted(os.listdir(fpath))
+        self.bkgeventrefs = []
         self.current_event_ctr = 0
 
         for bkgigfilename in bkgigfilenames:
             with zipfile.ZipFile(fpath+bkgigfilename, 'r') as bkgigfile:
                 bkgignames = bkgigfile.namelist()
-                for bkgigname in bkgignames:
-                    if bkgigname == 'Header':
-                        continue
+            for bkgigname in bkgignames:
+                if bkgigname == 'Header':
+                    continue
+                self.bkgeventrefs.append((fpath+bkgigfilename, bkgigname))
 
-                    self.bkgeventnames.append(bkgigname)
-                    with bkgigfile.open(bkgigname) as bkgigevent:
-                        bkgevent = json.load(bkgigevent)
-                    self.bkgevents.append(bkgevent)
+        # Random events of the pool instead of the first ones
+        if sample:
+            random.Random(seed).shuffle(self.bkgeventrefs)
 
     def get_bkg_len(self):
-        return len(self.bkgevents)
+        return len(self.bkgeventrefs)
     
-    def get_next_background_event(self):
-        if self.current_event_ctr < len(self.bkgeventnames):
-            current_event_name = self.bkgeventnames[self.current_event_ctr]
-            current_event = self.bkgevents[self.current_event_ctr]
+    def get_next_background_ref(self):
+        if self.current_event_ctr < len(self.bkgeventrefs):
+            current_event_ref = self.bkgeventrefs[self.current_event_ctr]
             self.current_event_ctr += 1
         else:
             raise RuntimeError('Exceeding available background events')
+
+        return current_event_ref
+
+    def get_next_background_event(self):
+        bkgigfilename, current_event_name = self.get_next_background_ref()
+
+        with zipfile.ZipFile(bkgigfilename, 'r') as bkgigfile:
+            with bkgigfile.open(current_event_name) as bkgigevent:
+                current_event = json.load(bkgigevent)
         
         return (current_event_name, current_event)
 
 
-def make_shuffled_ig_sets(shuffled_events, nsets, nevtpset, bkgset):
-    
+class IGFilePool:
+
+    # The least recently used IG file is closed once the pool is full
+    def __init__(self, size=IG_FILE_POOL_SIZE):
+        self.size = size
+        self.igfiles = collections.OrderedDict()
+
+    def get(self, igfilename):
+        if igfilename in self.igfiles:
+            self.igfiles.move_to_end(igfilename)
+            return self.igfiles[igfilename]
+
+        if len(self.igfiles) >= self.size:
+            _, igfile = self.igfiles.popitem(last=False)
+            igfile.close()
+        igfile = zipfile.ZipFile(igfilename, 'r')
+        self.igfiles[igfilename] = igfile
+        return igfile
+
+    def close(self):
+        for igfile in self.igfiles.values():
+            igfile.close()
+        self.igfiles.clear()
+
+
+def copy_ig_event(zin, zout, name, transform=None):
+
+    # The output entry keeps the timestamp of the source, so the mixed sets are reproducible
+    info = zin.getinfo(name)
+    out_info = zipfile.ZipInfo(name, info.date_time)
+    out_info.compress_type = zout.compression
+    out_info.external_attr = info.external_attr
+
+    # The event is only parsed when it is transformed
+    if transform is not None:
+        with zin.open(name) as inigeventf:
+            inigevent = json.load(inigeventf)
+        zout.writestr(out_info, json.dumps(transform(inigevent)), compresslevel=zout.compresslevel)
+        return
+
+    # The member bytes are copied as they are, without going through JSON
+    zout.writestr(out_info, zin.read(name), compresslevel=zout.compresslevel)
+
+
+def make_ig_set(nset, shuffled_event_set, bkgrefs, compresslevel=None, transform=None):
+
+    # Runs in a worker process, the background events of the set are assigned up front
+    igfile_pool = IGFilePool()
+    bkgrefs = iter(bkgrefs)
+
+    with zipfile.ZipFile(f'./mixedigfiles/fourlepton_{nset}.ig',
+                         "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zoutset:
+        for shuffled_event in shuffled_event_set:
+            inigfile = shuffled_event['file']
+
+            if inigfile == 'background':
+                bkgigfilename, igbkgname = next(bkgrefs)
+                copy_ig_event(igfile_pool.get(bkgigfilename), zoutset, igbkgname, transform)
+            else:
+                copy_ig_event(igfile_pool.get(inigfile), zoutset, shuffled_event['member'], transform)
+
+    igfile_pool.close()
+
+    with open(f'./mixedigfiles/event_info_{nset}.json', 'w') as json_dump_f:
+        json.dump(shuffled_event_set, json_dump_f, indent=4)
+
+
+def make_shuffled_ig_sets(shuffled_events, nsets, nevtpset, bkgset, compresslevel=None, transform=None,
+                          workers=None):
+
+    # The background events are handed out in set order before the sets are written in
+    # parallel, so the output does not depend on the order the workers finish in
+    shuffled_event_sets = []
+    bkgrefs = []
     for nset in range(nsets):
         shuffled_event_set = shuffled_events[nset*nevtpset:(nset+1)*nevtpset]
-        
-        with zipfile.ZipFile(f'./mixedigfiles/fourlepton_{nset}.ig',
-                             "w", compression=zipfile.ZIP_DEFLATED) as zoutset:
-            for shuffled_event in shuffled_event_set:
-                inigfile = shuffled_event['file']
-
-                if inigfile == 'background':
-                    igbkgname, igbkgevent = bkgset.get_next_background_event()
-                    igeventdump = json.dumps(igbkgevent)
-                    zoutset.writestr(igbkgname, igeventdump)
-                else:
-                    run = shuffled_event['run']
-                    event = shuffled_event['event']
-                    name = f'Events/Run_{run}/Event_{event}'
-
-                    with zipfile.ZipFile(inigfile, "r") as inigf:
-                        with inigf.open(name) as inigeventf:
-                            inigevent = json.load(inigeventf)
-
-                    igeventdump = json.dumps(inigevent)
-                    zoutset.writestr(name, igeventdump)
-        
-        with open(f'./mixedigfiles/event_info_{nset}.json', 'w') as json_dump_f:
-            json.dump(shuffled_event_set, json_dump_f, indent=4)
+        shuffled_event_sets.append(shuffled_event_set)
+        bkgrefs.append([bkgset.get_next_background_ref() for shuffled_event in shuffled_event_set
+                        if shuffled_event['file'] == 'background'])
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(make_ig_set, nset, shuffled_event_sets[nset], bkgrefs[nset], compresslevel, transform)
+                   for nset in range(nsets)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 if __name__ == "__main__":
@@ -165,7 +285,8 @@ if __name__ == "__main__":
     print(len(sigsets))
 
     bkgsetfpath = dataconfig['BackgroundSet']['igfiles']
-    bkgset = BackgroundSet(bkgsetfpath)
+    bkgset = BackgroundSet(bkgsetfpath, dataconfig['BackgroundSet'].get('sample', False),
+                           dataconfig['BackgroundSet'].get('seed'))
 
     sevents = make_unique_events(sigsets)
     print("Length of unique signal events: ", len(sevents))
@@ -188,7 +309,8 @@ if __name__ == "__main__":
     bevents = [{'file': 'background'}] * nbevents
 
     allevents = sevents + bevents
-    shuffled_events = random.sample(allevents, len(allevents))
+    shuffled_events = random.Random(dataconfig['General'].get('seed')).sample(allevents, len(allevents))
     
     print("\nShuffling datasets and generating outreach data!\n")
-    make_shuffled_ig_sets(shuffled_events, nsets, nevtpset, bkgset)
+    make_shuffled_ig_sets(shuffled_events, nsets, nevtpset, bkgset, dataconfig['General'].get('compresslevel'),
+                          workers=dataconfig['General'].get('workers'))
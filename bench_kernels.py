@@ -0,0 +1,134 @@
+import argparse
+import os
+import time
+
+import ROOT
+from ROOT import RDataFrame
+
+import cpp_utils
+
+
+# Synthetic NanoAOD-like muon and FSR photon collections with the native column types,
+# so the 4mu kernel chain can be timed without remote inputs
+CPPFUNC_BenchCollections = """
+#include <random>
+
+ROOT::VecOps::RVec<float> bench_uniform(ULong64_t entry, unsigned int stream, std::size_t n, float lo, float hi) {
+    std::minstd_rand rng(entry * 7919 + stream);
+    std::uniform_real_distribution<float> dist(lo, hi);
+    ROOT::VecOps::RVec<float> values(n);
+    for (auto& value : values) value = dist(rng);
+    return values;
+}
+
+ROOT::VecOps::RVec<int> bench_charges(ULong64_t entry, std::size_t n) {
+    std::minstd_rand rng(entry * 7919 + 17);
+    ROOT::VecOps::RVec<int> charges(n);
+    for (auto& charge : charges) charge = (rng() % 2) ? 1 : -1;
+    return charges;
+}
+
+ROOT::VecOps::RVec<int> bench_fsrphotonidx(ULong64_t entry, std::size_t n, std::size_t nfsr) {
+    ROOT::VecOps::RVec<int> idxs(n, -1);
+    for (std::size_t i = 0; i < nfsr && i < n; i++) idxs[(entry + i) % n] = i;
+    return idxs;
+}
+"""
+
+
+def make_bench_input(input_file: str, nevents: int):
+
+    ROOT.gInterpreter.Declare(CPPFUNC_BenchCollections)
+
+    df = RDataFrame(nevents)
+    df = df.Define("nMuTight", "static_cast<std::size_t>(4 + rdfentry_ % 5)")
+    df = df.Define("nFsrPhoton", "static_cast<std::size_t>(rdfentry_ % 3)")
+    df = df.Define("MuTight_pt", "bench_uniform(rdfentry_, 1, nMuTight, 5.f, 80.f)")
+    df = df.Define("MuTight_eta", "bench_uniform(rdfentry_, 2, nMuTight, -2.4f, 2.4f)")
+    df = df.Define("MuTight_phi", "bench_uniform(rdfentry_, 3, nMuTight, -3.14f, 3.14f)")
+    df = df.Define("MuTight_charge", "bench_charges(rdfentry_, nMuTight)")
+    df = df.Define("MuTight_fsrPhotonIdx", "bench_fsrphotonidx(rdfentry_, nMuTight, nFsrPhoton)")
+    df = df.Define("FsrPhoton_pt", "bench_uniform(rdfentry_, 4, nFsrPhoton, 2.f, 20.f)")
+    df = df.Define("FsrPhoton_eta", "bench_uniform(rdfentry_, 5, nFsrPhoton, -2.4f, 2.4f)")
+    df = df.Define("FsrPhoton_phi", "bench_uniform(rdfentry_, 6, nFsrPhoton, -3.14f, 3.14f)")
+    df.Snapshot("Events", input_file, ["MuTight_pt", "MuTight_eta", "MuTight_phi", "MuTight_charge",
+                                       "MuTight_fsrPhotonIdx", "FsrPhoton_pt", "FsrPhoton_eta", "FsrPhoton_phi"])
+
+
+def define_4mu_pair_chain(df):
+
+    # Kernels on the lepton pair table of cpp_kernels.cpp
+    df = df.Define("MuTight_dressed", "DressLeptons(MuTight_pt, MuTight_eta, MuTight_phi, MuTight_charge, MuTight_fsrPhotonIdx," \
+                                      "0.10565, FsrPhoton_pt, FsrPhoton_eta, FsrPhoton_phi)")
+    df = df.Define("MuTight_pairs", "PairLeptons(MuTight_dressed)")
+    df = df.Define("M_ZToMuMu", "FindAll_ZToLPLN(MuTight_pairs)")
+    df = df.Define("ZZTo4MuIdxs", "Find_NonOverlappingZZ_To_4Lep(MuTight_pairs)")
+    df_zz = df.Filter("ZZTo4MuIdxs.size() == 4")
+    df_zz = df_zz.Define("fourlep_mass", "Analysis_HTo4Lep(MuTight_pairs, ZZTo4MuIdxs[0], ZZTo4MuIdxs[1]," \
+                                         "MuTight_pairs, ZZTo4MuIdxs[2], ZZTo4MuIdxs[3], ZZTo4MuIdxs[1])")
+    return df, df_zz
+
+
+def define_4mu_lepton_chain(df):
+
+    # Kernels taking the lepton collections and the four leptons one by one, as in the
+    # baseline cpp_utils; the second Z takes the photon of the first negative muon like
+    # the baseline 4mu analyser
+    df = df.Define("M_ZToMuMu", "FindAll_ZToLPLN(MuTight_pt, MuTight_eta, MuTight_phi, MuTight_charge, MuTight_fsrPhotonIdx," \
+                                "0.10565, FsrPhoton_pt, FsrPhoton_eta, FsrPhoton_phi)")
+    df = df.Define("ZZTo4MuIdxs", "Find_NonOverlappingZZ_To_4Lep(MuTight_pt, MuTight_eta, MuTight_phi," \
+                                  "MuTight_charge, MuTight_fsrPhotonIdx, 0.10565," \
+                                  "FsrPhoton_pt, FsrPhoton_eta, FsrPhoton_phi)")
+    df_zz = df.Filter("ZZTo4MuIdxs.size() == 4")
+    for i, lep in enumerate(["z1mup", "z1mun", "z2mup", "z2mun"]):
+        for var in ["pt", "eta", "phi", "fsrPhotonIdx"]:
+            df_zz = df_zz.Define(f"{lep}_{var}", f"MuTight_{var}[ZZTo4MuIdxs[{i}]]")
+    df_zz = df_zz.Define("fourlep_mass", "Analysis_HTo4Lep(z1mup_pt, z1mup_eta, z1mup_phi, z1mup_fsrPhotonIdx," \
+                                         "z1mun_pt, z1mun_eta, z1mun_phi, z1mun_fsrPhotonIdx," \
+                                         "z2mup_pt, z2mup_eta, z2mup_phi, z2mup_fsrPhotonIdx," \
+                                         "z2mun_pt, z2mun_eta, z2mun_phi, z1mun_fsrPhotonIdx," \
+                                         "0.10565, 0.10565, FsrPhoton_pt, FsrPhoton_eta, FsrPhoton_phi)")
+    return df, df_zz
+
+
+def run_4mu_chain(input_file: str):
+
+    # Step 3 and step 4 of the 4mu analyser, on already selected muons, with the kernel
+    # signatures of the checkout of cpp_utils being timed
+    df = RDataFrame("Events", input_file)
+    if hasattr(ROOT, "PairLeptons"):
+        df, df_zz = define_4mu_pair_chain(df)
+    else:
+        df, df_zz = define_4mu_lepton_chain(df)
+
+    n_events = df.Count()
+    n_zmasses = df.Sum("M_ZToMuMu.size()")
+    sum_mass = df_zz.Sum("fourlep_mass")
+
+    start_time = time.time()
+    n_events = n_events.GetValue()
+    elapsed = time.time() - start_time
+
+    print(f"Processed {n_events} events in {elapsed:.3f} seconds: {n_events / elapsed:.0f} events/s "
+          f"(Z masses: {n_zmasses.GetValue():.0f}, sum of 4mu masses: {sum_mass.GetValue():.3f})")
+
+
+if __name__ == "__main__":
+
+    # Run on two checkouts of cpp_utils to compare the kernels before and after a change;
+    # the Z count and mass sum must agree between the two
+    parser = argparse.ArgumentParser(description="Benchmark the 4mu kernel chain of cpp_utils")
+    parser.add_argument("--events", type=int, default=2000000, help="Number of synthetic events")
+    parser.add_argument("--input", default="bench_4mu_input.root", help="Synthetic input file, created if missing")
+    parser.add_argument("--threads", type=int, default=0, help="Threads for implicit MT, 0 runs single threaded")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        make_bench_input(args.input, args.events)
+
+    if args.threads > 0:
+        ROOT.EnableImplicitMT(args.threads)
+
+    cpp_utils.cpp_utils()
+
+    run_4mu_chain(args.input)
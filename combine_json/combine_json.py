@@ -1,79 +1,114 @@
 # Combine json file per dataset to a single json file
 
+import argparse
+import concurrent.futures
+import glob
 import json
-
-
-def combine_json_files(newfilename: str, oldfilelist: list[dict]):
-
-    newevents = []
+import os
+import re
+import textwrap
+
+
+# Candidate files are named <channel>_<dataset>.json, e.g. 4mu_doublemu_2016G.json.
+# Events selected by several channels are kept from the first channel in this order
+CHANNEL_PRIORITY = ['4mu', '4e', '2mu2e']
+CANDIDATE_FILE_PATTERN = re.compile(r'^(?P<type>' + '|'.join(CHANNEL_PRIORITY) + r')_(?P<dataset>.+)\.json$')
+
+# Characters read at once from the input files
+READ_CHUNK_SIZE = 1 << 20
+
+
+def iter_json_array(filename: str, chunk_size: int = READ_CHUNK_SIZE):
+
+    # Yields the objects of a json array one by one, holding one chunk of the file in memory
+    decoder = json.JSONDecoder()
+    with open(filename, 'r') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        while True:
+            # Skip whitespace and the array punctuation between objects
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n[],':
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    return
+                buffer = f.read(chunk_size)
+                pos = 0
+                eof = len(buffer) == 0
+                continue
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The object continues in the next chunk
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield obj
+            pos = end
+
+
+def combine_json_files(newfilename: str, oldfilelist: list[dict], output_dir: str = '../skimmingcrabconfigs'):
+
+    # Events are identified by (run, luminosityBlock, event), event numbers alone repeat across runs
+    seen_events = set()
+    n_events = 0
     duplicate_event_count = 0
-
-    for oldfiledict in oldfilelist:
-
-        oldfiletype = oldfiledict['type']
-        oldfile = oldfiledict['file']
-
-        with open(oldfile, 'r') as f:
-            events = json.load(f)
-
-        for event in events:
-            event['type'] = oldfiletype
-            if len(newevents) == 0:
-                newevents.append(event)
-            else:
-                found_event = False
-                for ex_events in newevents:
-                    if event['event'] == ex_events['event']:
-                        print(event)
-                        found_event = True
-                        duplicate_event_count += 1
-                if not found_event:
-                        # print(f"Append new event to exisitng size {len(newevents)}")
-                        newevents.append(event)
-
-    with open(f"../skimmingcrabconfigs/{newfilename}", 'w') as f:
-        print(f"Count of duplicate events: {duplicate_event_count}")
-        print(f"Dumping merged json of {len(newevents)} events "
-              f"to ../skimmingcrabconfigs/{newfilename}")
-        json.dump(newevents, f, indent = 4)
+    output_path = os.path.join(output_dir, newfilename)
+
+    # Written as the inputs are read, in the layout of json.dump(events, f, indent=4)
+    with open(output_path, 'w') as f:
+        for oldfiledict in oldfilelist:
+            for event in iter_json_array(oldfiledict['file']):
+                key = (event['run'], event['luminosityBlock'], event['event'])
+                if key in seen_events:
+                    duplicate_event_count += 1
+                    continue
+                seen_events.add(key)
+                event['type'] = oldfiledict['type']
+                f.write(',\n' if n_events > 0 else '[\n')
+                f.write(textwrap.indent(json.dumps(event, indent=4), '    '))
+                n_events += 1
+        f.write('\n]' if n_events > 0 else '[]')
+
+    print(f"Count of duplicate events: {duplicate_event_count}")
+    print(f"Dumped merged json of {n_events} events to {output_path}")
+
+
+def group_candidate_files(input_glob: str) -> dict:
+
+    # Maps every dataset to its candidate files in channel priority order
+    datasets = {}
+    for filename in sorted(glob.glob(input_glob)):
+        match = CANDIDATE_FILE_PATTERN.match(os.path.basename(filename))
+        if match is None:
+            continue
+        datasets.setdefault(match['dataset'], []).append({'type': match['type'], 'file': filename})
+
+    for oldfilelist in datasets.values():
+        oldfilelist.sort(key=lambda oldfiledict: CHANNEL_PRIORITY.index(oldfiledict['type']))
+    return datasets
 
 
 if __name__ == "__main__":
 
-    oldfilelist = [{'type': '4mu', 'file': '4mu_doublemu_2016G.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_doublemu_2016G.json'}]
-    combine_json_files("doublemu_2016G.json", oldfilelist)
-
-    oldfilelist = [{'type': '4mu', 'file': '4mu_doublemu_2016H.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_doublemu_2016H.json'}]
-    combine_json_files("doublemu_2016H.json", oldfilelist)
-
-    oldfilelist = [{'type': '4mu', 'file': '4mu_singlemu_2016G.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_singlemu_2016G.json'}]
-    combine_json_files("singlemu_2016G.json", oldfilelist)
-
-    oldfilelist = [{'type': '4mu', 'file': '4mu_singlemu_2016H.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_singlemu_2016H.json'}]
-    combine_json_files("singlemu_2016H.json", oldfilelist)
-
-    oldfilelist = [{'type': '4e', 'file': '4e_doubleel_2016G.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_doubleel_2016G.json'}]
-    combine_json_files("doubleel_2016G.json", oldfilelist)
-
-    oldfilelist = [{'type': '4e', 'file': '4e_doubleel_2016H.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_doubleel_2016H.json'}]
-    combine_json_files("doubleel_2016H.json", oldfilelist)
-
-    oldfilelist = [{'type': '4e', 'file': '4e_singleel_2016G.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_singleel_2016G.json'}]
-    combine_json_files("singleel_2016G.json", oldfilelist)
-
-    oldfilelist = [{'type': '4e', 'file': '4e_singleel_2016H.json'},
-                   {'type': '2mu2e', 'file': '2mu2e_singleel_2016H.json'}]
-    combine_json_files("singleel_2016H.json", oldfilelist)
-
-    oldfilelist = [{'type': '2mu2e', 'file': '2mu2e_mueg_2016G.json'}]
-    combine_json_files("mueg_2016G.json", oldfilelist)
-
-    oldfilelist = [{'type': '2mu2e', 'file': '2mu2e_mueg_2016H.json'}]
-    combine_json_files("mueg_2016H.json", oldfilelist)
+    parser = argparse.ArgumentParser(description="Combine the per-channel candidate json files of every dataset")
+    parser.add_argument("--inputs", default="*.json",
+                        help="Glob of the <channel>_<dataset>.json candidate files")
+    parser.add_argument("--output-dir", default="../skimmingcrabconfigs",
+                        help="Directory of the combined <dataset>.json files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Datasets combined concurrently")
+    args = parser.parse_args()
+
+    datasets = group_candidate_files(args.inputs)
+
+    # The datasets are independent, each one is combined in its own process
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(combine_json_files, f"{dataset}.json", oldfilelist, args.output_dir)
+                   for dataset, oldfilelist in datasets.items()]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
@@ -0,0 +1,595 @@
+#include <algorithm>
+#include <array>
+#include <cctype>
+#include <chrono>
+#include <cmath>
+#include <deque>
+#include <fstream>
+#include <map>
+#include <memory>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include "Math/Vector4D.h"
+#include "Math/VectorUtil.h"
+#include "ROOT/RDataFrame.hxx"
+#include "ROOT/RVec.hxx"
+#include "TDirectory.h"
+#include "TH1D.h"
+
+
+// Define the certified lumi mask, parsed natively from the golden JSON into sorted
+// flat lumi ranges per run and searched with a binary search per event
+class LumiMask {
+public:
+    explicit LumiMask(const std::string& path) {
+        std::ifstream json_f(path);
+        if (!json_f) throw std::runtime_error("Cannot open lumi mask file " + path);
+        std::stringstream buffer;
+        buffer << json_f.rdbuf();
+        const std::string text = buffer.str();
+
+        // Golden JSON format: {"run": [[first, last], ...], ...}
+        std::vector<std::array<unsigned int, 3>> ranges;
+        std::vector<unsigned int> bounds;
+        unsigned int run = 0;
+        bool has_run = false;
+        for (std::size_t i = 0; i < text.size();) {
+            if (text[i] == '"') {
+                std::size_t end = text.find('"', i + 1);
+                run = std::stoul(text.substr(i + 1, end - i - 1));
+                has_run = true;
+                bounds.clear();
+                i = end + 1;
+            }
+            else if (std::isdigit(static_cast<unsigned char>(text[i]))) {
+                unsigned int value = 0;
+                while (i < text.size() && std::isdigit(static_cast<unsigned char>(text[i])))
+                    value = 10 * value + (text[i++] - '0');
+                if (!has_run) throw std::runtime_error("Malformed lumi mask file " + path);
+                bounds.push_back(value);
+                if (bounds.size() == 2) {
+                    ranges.push_back({run, bounds[0], bounds[1]});
+                    bounds.clear();
+                }
+            }
+            else {
+                i++;
+            }
+        }
+
+        std::sort(ranges.begin(), ranges.end());
+        for (const auto& range : ranges) {
+            // Merge overlapping or touching ranges of the same run
+            if (!fRuns.empty() && fRuns.back() == range[0] && range[1] <= fLast.back() + 1) {
+                fLast.back() = std::max(fLast.back(), range[2]);
+                continue;
+            }
+            if (fRuns.empty() || fRuns.back() != range[0]) {
+                fRuns.push_back(range[0]);
+                fOffsets.push_back(fFirst.size());
+            }
+            fFirst.push_back(range[1]);
+            fLast.push_back(range[2]);
+        }
+        fOffsets.push_back(fFirst.size());
+    }
+
+    bool accept(unsigned int run, unsigned int lumi) const {
+        auto run_it = std::lower_bound(fRuns.begin(), fRuns.end(), run);
+        if (run_it == fRuns.end() || *run_it != run) return false;
+        std::size_t irun = run_it - fRuns.begin();
+        auto begin = fFirst.begin() + fOffsets[irun];
+        auto end = fFirst.begin() + fOffsets[irun + 1];
+        // Last range starting at or before the lumi section
+        auto it = std::upper_bound(begin, end, lumi);
+        if (it == begin) return false;
+        return lumi <= fLast[(it - fFirst.begin()) - 1];
+    }
+
+private:
+    std::vector<unsigned int> fRuns;
+    std::vector<std::size_t> fOffsets;
+    std::vector<unsigned int> fFirst;
+    std::vector<unsigned int> fLast;
+};
+
+// Masks loaded in this process, addressed by index from the Filter expressions
+std::deque<LumiMask> lumiMasks;
+std::map<std::string, int> lumiMaskIdxs;
+
+int load_lumi_mask(const std::string& path) {
+    auto it = lumiMaskIdxs.find(path);
+    if (it != lumiMaskIdxs.end()) return it->second;
+    lumiMasks.emplace_back(path);
+    int mask_idx = lumiMasks.size() - 1;
+    lumiMaskIdxs[path] = mask_idx;
+    return mask_idx;
+}
+
+bool is_valid_in(int mask_idx, unsigned int run, unsigned int lumi) {
+    if (mask_idx < 0) return true;
+    return lumiMasks[mask_idx].accept(run, lumi);
+}
+
+
+// Define the per-slot timers and pass counters of instrumented Filter and Define nodes.
+// A NodeTimerScope temporary times the rest of the full expression it is created in
+struct alignas(64) NodeTimerSlot {
+    unsigned long long calls = 0;
+    unsigned long long passed = 0;
+    std::chrono::steady_clock::duration time{0};
+};
+
+std::deque<std::vector<NodeTimerSlot>> nodeTimers;
+
+int register_node_timer(unsigned int nslots) {
+    nodeTimers.emplace_back(nslots);
+    return nodeTimers.size() - 1;
+}
+
+class NodeTimerScope {
+public:
+    NodeTimerScope(int node_idx, unsigned int slot)
+        : fSlot(nodeTimers[node_idx][slot]), fStart(std::chrono::steady_clock::now()) {}
+    ~NodeTimerScope() {
+        fSlot.time += std::chrono::steady_clock::now() - fStart;
+        fSlot.calls++;
+    }
+
+private:
+    NodeTimerSlot& fSlot;
+    std::chrono::steady_clock::time_point fStart;
+};
+
+bool node_count_pass(int node_idx, unsigned int slot, bool pass) {
+    if (pass) nodeTimers[node_idx][slot].passed++;
+    return pass;
+}
+
+ROOT::VecOps::RVec<double> node_timer_totals(int node_idx) {
+    // Calls, passed and seconds summed over the slots
+    ROOT::VecOps::RVec<double> totals(3, 0.0);
+    for (const auto& slot : nodeTimers[node_idx]) {
+        totals[0] += slot.calls;
+        totals[1] += slot.passed;
+        totals[2] += std::chrono::duration<double>(slot.time).count();
+    }
+    return totals;
+}
+
+
+// Define the histogram bank, a single action filling every histogram of one dataframe node.
+// Each column is read once per event and fills all the histograms booked on it, the slot
+// copies are added to the slot 0 histograms at the end as done by Histo1D
+struct HistoSpec {
+    HistoSpec(const std::string& name, const std::string& title, int nbins, double xlow, double xhigh, int column)
+        : name(name), title(title), nbins(nbins), xlow(xlow), xhigh(xhigh), column(column) {}
+    std::string name;
+    std::string title;
+    int nbins;
+    double xlow;
+    double xhigh;
+    int column;
+};
+
+template <typename... Cols>
+class HistoBankHelper : public ROOT::Detail::RDF::RActionImpl<HistoBankHelper<Cols...>> {
+public:
+    using Result_t = std::vector<TH1D>;
+
+    HistoBankHelper(unsigned int nslots, const std::vector<HistoSpec>& specs)
+        : fResult(std::make_shared<Result_t>()), fSlotHistos(nslots), fColumnHistos(sizeof...(Cols)) {
+        // The histograms are owned by the bank, not by the current directory
+        TDirectory::TContext context(nullptr);
+        fResult->reserve(specs.size());
+        for (std::size_t i = 0; i < specs.size(); i++) {
+            const HistoSpec& spec = specs[i];
+            fResult->emplace_back(spec.name.c_str(), spec.title.c_str(), spec.nbins, spec.xlow, spec.xhigh);
+            fColumnHistos[spec.column].push_back(i);
+        }
+        // Slot 0 fills the result itself, the other slots fill their own copies
+        fSlotCopies.resize(nslots > 0 ? nslots - 1 : 0, *fResult);
+        for (unsigned int slot = 0; slot < nslots; slot++) {
+            Result_t& histos = slot == 0 ? *fResult : fSlotCopies[slot - 1];
+            for (auto& histo : histos) fSlotHistos[slot].push_back(&histo);
+        }
+    }
+    HistoBankHelper(HistoBankHelper&&) = default;
+    HistoBankHelper(const HistoBankHelper&) = delete;
+
+    std::shared_ptr<Result_t> GetResultPtr() const { return fResult; }
+    void Initialize() {}
+    void InitTask(TTreeReader*, unsigned int) {}
+
+    void Exec(unsigned int slot, const Cols&... values) {
+        std::size_t column = 0;
+        (FillColumn(slot, column++, values), ...);
+    }
+
+    void Finalize() {
+        for (auto& histos : fSlotCopies) {
+            for (std::size_t i = 0; i < histos.size(); i++) (*fResult)[i].Add(&histos[i]);
+        }
+    }
+
+    std::string GetActionName() { return "HistoBank"; }
+
+private:
+    template <typename T>
+    void FillColumn(unsigned int slot, std::size_t column, const T& value) {
+        for (std::size_t i : fColumnHistos[column]) fSlotHistos[slot][i]->Fill(static_cast<double>(value));
+    }
+
+    template <typename T>
+    void FillColumn(unsigned int slot, std::size_t column, const ROOT::VecOps::RVec<T>& values) {
+        for (std::size_t i : fColumnHistos[column]) {
+            TH1D* histo = fSlotHistos[slot][i];
+            for (const auto& value : values) histo->Fill(static_cast<double>(value));
+        }
+    }
+
+    std::shared_ptr<Result_t> fResult;
+    std::vector<Result_t> fSlotCopies;
+    std::vector<std::vector<TH1D*>> fSlotHistos;
+    std::vector<std::vector<std::size_t>> fColumnHistos;
+};
+
+// Instantiated from python with the column types of the node, e.g.
+// BookHistoBank["ROOT::VecOps::RVec<float>", "double"](ROOT.RDF.AsRNode(df), columns, specs)
+template <typename... Cols>
+ROOT::RDF::RResultPtr<std::vector<TH1D>> BookHistoBank(ROOT::RDF::RNode df, const std::vector<std::string>& columns,
+                                                       const std::vector<HistoSpec>& specs) {
+    return df.Book<Cols...>(HistoBankHelper<Cols...>(df.GetNSlots(), specs), columns);
+}
+
+
+// Define the per-event leptons of one flavour as a structure of arrays, holding the bare
+// four-vectors, the associated FSR photons and the pairwise DeltaR table computed once per event
+struct DressedLeptons {
+    std::size_t n = 0;
+    ROOT::VecOps::RVec<ROOT::Math::PtEtaPhiMVector> p4;
+    ROOT::VecOps::RVec<ROOT::Math::PtEtaPhiMVector> fsr_p4;
+    ROOT::VecOps::RVec<char> has_fsr;
+    ROOT::VecOps::RVec<int> q;
+    ROOT::VecOps::RVec<double> dr;
+
+    double DeltaR(std::size_t i, std::size_t j) const { return dr[i * n + j]; }
+    const ROOT::Math::PtEtaPhiMVector* Fsr(std::size_t i) const { return has_fsr[i] ? &fsr_p4[i] : nullptr; }
+    ROOT::Math::PtEtaPhiMVector Massless(std::size_t i) const {
+        return ROOT::Math::PtEtaPhiMVector(p4[i].Pt(), p4[i].Eta(), p4[i].Phi(), 0.0);
+    }
+};
+
+DressedLeptons DressLeptons(const ROOT::VecOps::RVec<float>& lep_pt,
+                            const ROOT::VecOps::RVec<float>& lep_eta,
+                            const ROOT::VecOps::RVec<float>& lep_phi,
+                            const ROOT::VecOps::RVec<int>& lep_q,
+                            const ROOT::VecOps::RVec<int>& lep_fsrgammaidx,
+                            double lep_m,
+                            const ROOT::VecOps::RVec<float>& fsrgamma_pt,
+                            const ROOT::VecOps::RVec<float>& fsrgamma_eta,
+                            const ROOT::VecOps::RVec<float>& fsrgamma_phi) {
+
+    DressedLeptons leps;
+    leps.n = lep_pt.size();
+    leps.p4.reserve(leps.n);
+    leps.fsr_p4.resize(leps.n);
+    leps.has_fsr.resize(leps.n, 0);
+    leps.q = lep_q;
+
+    for(std::size_t i=0; i<leps.n; i++) {
+        leps.p4.emplace_back(lep_pt[i], lep_eta[i], lep_phi[i], lep_m);
+        int fsrgammaidx = lep_fsrgammaidx.empty() ? -1 : lep_fsrgammaidx[i];
+        if(fsrgammaidx >= 0) {
+            leps.fsr_p4[i] = ROOT::Math::PtEtaPhiMVector(fsrgamma_pt[fsrgammaidx], fsrgamma_eta[fsrgammaidx],
+                                                         fsrgamma_phi[fsrgammaidx], 0.0);
+            leps.has_fsr[i] = 1;
+        }
+    }
+
+    leps.dr.resize(leps.n * leps.n, 0.0);
+    for(std::size_t i=0; i<leps.n; i++) {
+        for(std::size_t j=i+1; j<leps.n; j++) {
+            double dr = ROOT::Math::VectorUtil::DeltaR(leps.p4[i], leps.p4[j]);
+            leps.dr[i * leps.n + j] = dr;
+            leps.dr[j * leps.n + i] = dr;
+        }
+    }
+
+    return leps;
+}
+
+// Leptons without associated FSR photons, as used for the electrons
+DressedLeptons DressLeptons(const ROOT::VecOps::RVec<float>& lep_pt,
+                            const ROOT::VecOps::RVec<float>& lep_eta,
+                            const ROOT::VecOps::RVec<float>& lep_phi,
+                            const ROOT::VecOps::RVec<int>& lep_q,
+                            double lep_m) {
+    const ROOT::VecOps::RVec<float> no_fsrgamma;
+    return DressLeptons(lep_pt, lep_eta, lep_phi, lep_q, ROOT::VecOps::RVec<int>(), lep_m,
+                        no_fsrgamma, no_fsrgamma, no_fsrgamma);
+}
+
+
+// Define function to calculate Z four-vector from 2 leptons and associated FSR Photons.
+// The photons are added one by one after the leptons, the sums round differently in another order
+ROOT::Math::PtEtaPhiMVector ZFromLLpair(const ROOT::Math::PtEtaPhiMVector& lp,
+                                        const ROOT::Math::PtEtaPhiMVector& ln,
+                                        const ROOT::Math::PtEtaPhiMVector* gp,
+                                        const ROOT::Math::PtEtaPhiMVector* gn) {
+    ROOT::Math::PtEtaPhiMVector Z = lp + ln;
+    if(gp) Z += *gp;
+    if(gn) Z += *gn;
+    return Z;
+}
+
+
+// Define the per-event table of lepton pairs, with the FSR-dressed pair sums and masses,
+// the bare pair masses and DeltaR of every pair computed once in a single pass.
+// Entry (i, j) sums lepton i first, both orientations only differ if both leptons have a photon
+struct LeptonPairTable {
+    DressedLeptons leps;
+    ROOT::VecOps::RVec<ROOT::Math::PtEtaPhiMVector> p4;
+    ROOT::VecOps::RVec<double> mass;
+    ROOT::VecOps::RVec<double> bare_mass;
+
+    std::size_t n() const { return leps.n; }
+    int q(std::size_t i) const { return leps.q[i]; }
+    const ROOT::Math::PtEtaPhiMVector& P4(std::size_t i, std::size_t j) const { return p4[i * leps.n + j]; }
+    double M(std::size_t i, std::size_t j) const { return mass[i * leps.n + j]; }
+    double BareM(std::size_t i, std::size_t j) const { return bare_mass[i * leps.n + j]; }
+    double DeltaR(std::size_t i, std::size_t j) const { return leps.DeltaR(i, j); }
+};
+
+LeptonPairTable PairLeptons(const DressedLeptons& leps) {
+
+    LeptonPairTable pairs;
+    pairs.leps = leps;
+    std::size_t n = leps.n;
+    pairs.p4.resize(n * n);
+    pairs.mass.resize(n * n, 0.0);
+    pairs.bare_mass.resize(n * n, 0.0);
+
+    for(std::size_t i=0; i<n; i++) {
+        for(std::size_t j=i+1; j<n; j++) {
+            ROOT::Math::PtEtaPhiMVector Z_ij = ZFromLLpair(leps.p4[i], leps.p4[j], leps.Fsr(i), leps.Fsr(j));
+            ROOT::Math::PtEtaPhiMVector Z_ji = (leps.has_fsr[i] && leps.has_fsr[j]) ?
+                ZFromLLpair(leps.p4[j], leps.p4[i], leps.Fsr(j), leps.Fsr(i)) : Z_ij;
+            double bare_mass = (leps.p4[i] + leps.p4[j]).M();
+            pairs.p4[i * n + j] = Z_ij;
+            pairs.p4[j * n + i] = Z_ji;
+            pairs.mass[i * n + j] = Z_ij.M();
+            pairs.mass[j * n + i] = Z_ji.M();
+            pairs.bare_mass[i * n + j] = bare_mass;
+            pairs.bare_mass[j * n + i] = bare_mass;
+        }
+    }
+
+    return pairs;
+}
+
+
+// Define function to calculate Z mass from 2 leptons and associated FSR Photons
+double Zmass_FromLLpair(const LeptonPairTable& pairs, int lp, int ln) {
+    return pairs.M(lp, ln);
+}
+
+
+// Define a function to find lepton pairs with Z -> lep+ lep-
+ROOT::VecOps::RVec<double> FindAll_ZToLPLN(const LeptonPairTable& pairs) {
+
+    ROOT::VecOps::RVec<double> M_Z;
+
+    if(pairs.n() < 2) {
+        M_Z.push_back(-1);
+        return M_Z;
+    }
+
+    for(std::size_t i=0; i<pairs.n(); i++) {
+        for(std::size_t j=i+1; j<pairs.n(); j++) {
+            if(pairs.q(i)*pairs.q(j) < 0) {
+                double mass = pairs.M(i, j);
+                if(mass > 12 && mass < 120) {
+                    M_Z.push_back(mass);
+                }
+            }
+        }
+    }
+
+    return M_Z;
+}
+
+
+// Find the opposite charge pair closest to the Z mass, skipping leptons flagged in veto.
+// Returns false if no pair passes, otherwise sets lepp and lepn to the positive and negative lepton
+bool FindBest_ZToLPLN(const LeptonPairTable& pairs, const std::vector<char>& veto, int& lepp, int& lepn) {
+
+    double z_m = 91.19;
+    double Zcandmass = -1.0;
+    for(std::size_t i=0; i<pairs.n(); i++) {
+        if(veto[i]) continue;
+        for(std::size_t j=i+1; j<pairs.n(); j++) {
+            if(veto[j]) continue;
+            if(pairs.q(i)*pairs.q(j) < 0 && pairs.DeltaR(i, j) > 0.02) {
+                double mass = pairs.M(i, j);
+                if(mass > 12 && mass < 120) {
+                    if(Zcandmass == -1.0 || std::abs(mass-z_m) < std::abs(Zcandmass-z_m)) {
+                        Zcandmass = mass;
+                        lepp = pairs.q(i) > 0 ? i : j;
+                        lepn = pairs.q(i) < 0 ? i : j;
+                    }
+                }
+            }
+        }
+    }
+
+    return Zcandmass != -1.0;
+}
+
+
+// Define a function to find non-overlapping ZZ -> 2lep+ 2lep- candidates
+// Includes none of the leptons should be within DeltaR < 0.02 of each other
+ROOT::VecOps::RVec<int> Find_NonOverlappingZZ_To_4Lep(const LeptonPairTable& pairs) {
+
+    ROOT::VecOps::RVec<int> ZZTo4LepIdxs;
+
+    if(pairs.n() < 4) {
+        return ZZTo4LepIdxs;
+    }
+
+    std::vector<char> veto(pairs.n(), 0);
+    int lepp = -1, lepn = -1;
+    if(!FindBest_ZToLPLN(pairs, veto, lepp, lepn)) {
+        return ZZTo4LepIdxs;
+    }
+    ZZTo4LepIdxs.push_back(lepp);
+    ZZTo4LepIdxs.push_back(lepn);
+
+    // The second Z is built from leptons not used by, nor overlapping with, the first one
+    for(std::size_t i=0; i<pairs.n(); i++) {
+        veto[i] = (int)i == lepp || (int)i == lepn || pairs.DeltaR(i, lepp) < 0.02 || pairs.DeltaR(i, lepn) < 0.02;
+    }
+
+    int leppz2 = -1, lepnz2 = -1;
+    if(FindBest_ZToLPLN(pairs, veto, leppz2, lepnz2)) {
+        ZZTo4LepIdxs.push_back(leppz2);
+        ZZTo4LepIdxs.push_back(lepnz2);
+    }
+
+    return ZZTo4LepIdxs;
+}
+
+
+// Define a function to perform Higgs Analysis and calculate the invariant mass of four leptons
+// Pairs within one table are read from it, mixed flavour pairs are computed from the leptons.
+// z2lepn_fsrlep >= 0 dresses z2lepn with the photon of that z2 lepton instead of its own,
+// as the 4mu analyser always did with the photon of z1lepn
+double Analysis_HTo4Lep(const LeptonPairTable& z1pairs, int z1lepp, int z1lepn,
+                        const LeptonPairTable& z2pairs, int z2lepp, int z2lepn, int z2lepn_fsrlep = -1) {
+
+    double mass = -10.0, z_m = 91.19;
+    bool same_pairs = &z1pairs == &z2pairs;
+    const DressedLeptons& z1leps = z1pairs.leps;
+    const DressedLeptons& z2leps = z2pairs.leps;
+    const ROOT::Math::PtEtaPhiMVector* z2lepn_fsr = z2leps.Fsr(z2lepn_fsrlep >= 0 ? z2lepn_fsrlep : z2lepn);
+
+    auto cross_dr = [&](int i1, int i2) {
+        return same_pairs ? z1pairs.DeltaR(i1, i2) : ROOT::Math::VectorUtil::DeltaR(z1leps.p4[i1], z2leps.p4[i2]);
+    };
+    auto cross_bare_m = [&](int i1, int i2) {
+        return same_pairs ? z1pairs.BareM(i1, i2) : (z1leps.p4[i1] + z2leps.p4[i2]).M();
+    };
+
+    // GHOST REMOVAL
+    if(z1pairs.DeltaR(z1lepp, z1lepn) < 0.02 || z2pairs.DeltaR(z2lepp, z2lepn) < 0.02 ||
+       cross_dr(z1lepp, z2lepp) < 0.02 || cross_dr(z1lepp, z2lepn) < 0.02 ||
+       cross_dr(z1lepn, z2lepp) < 0.02 || cross_dr(z1lepn, z2lepn) < 0.02) {
+        return mass;
+    }
+
+    // LEPTON PT
+    double z1lepp_pt = z1leps.p4[z1lepp].Pt(), z1lepn_pt = z1leps.p4[z1lepn].Pt();
+    double z2lepp_pt = z2leps.p4[z2lepp].Pt(), z2lepn_pt = z2leps.p4[z2lepn].Pt();
+    if(z1lepp_pt<20 && z1lepn_pt<20 && z2lepp_pt<20 && z2lepn_pt<20) {
+        return mass;
+    }
+
+    int countptgt10 = 0;
+    if(z1lepp_pt > 10) countptgt10++;
+    if(z1lepn_pt > 10) countptgt10++;
+    if(z2lepp_pt > 10) countptgt10++;
+    if(z2lepn_pt > 10) countptgt10++;
+    if(countptgt10 < 2) {
+        return mass;
+    }
+
+    // QCD SUPRESSION
+    if(z1pairs.BareM(z1lepp, z1lepn) < 4 || z2pairs.BareM(z2lepp, z2lepn) < 4 ||
+       cross_bare_m(z1lepp, z2lepn) < 4 || cross_bare_m(z1lepn, z2lepp) < 4) {
+        return mass;
+    }
+
+    // Z1 MASS
+    double Z1_m = z1pairs.M(z1lepp, z1lepn);
+    if(Z1_m < 40.0) {
+        return mass;
+    }
+
+    // SMART CUT
+    // The mixed pairs are built from massless leptons and their photons
+    double Z12_m = ZFromLLpair(z1leps.Massless(z1lepp), z2leps.Massless(z2lepn), z1leps.Fsr(z1lepp), z2lepn_fsr).M();
+    double Z21_m = ZFromLLpair(z2leps.Massless(z2lepp), z1leps.Massless(z1lepn), z2leps.Fsr(z2lepp), z1leps.Fsr(z1lepn)).M();
+    double Za_m = (std::abs(Z12_m-z_m) < std::abs(Z21_m-z_m)) ? Z12_m : Z21_m;
+    double Zb_m = (std::abs(Z12_m-z_m) < std::abs(Z21_m-z_m)) ? Z21_m : Z12_m;
+    if( (std::abs(Za_m-z_m) < std::abs(Z1_m-z_m)) && (Zb_m < 12) ) {
+        return mass;
+    }
+
+    ROOT::Math::PtEtaPhiMVector Z2 = z2lepn_fsrlep >= 0 ?
+        ZFromLLpair(z2leps.p4[z2lepp], z2leps.p4[z2lepn], z2leps.Fsr(z2lepp), z2lepn_fsr) : z2pairs.P4(z2lepp, z2lepn);
+    mass = (z1pairs.P4(z1lepp, z1lepn) + Z2).M();
+
+    return mass;
+}
+
+
+// Define a function to find non-overlapping ZZ -> mu+ mu- candidates
+// Includes none of the leptons should be within DeltaR < 0.02 of each other
+ROOT::VecOps::RVec<int> Find_NonOverlappingZZ_To_2Mu2El(const LeptonPairTable& mupairs, const LeptonPairTable& elpairs) {
+
+    ROOT::VecOps::RVec<int> ZZTo4LepIdxs;
+
+    if(mupairs.n() < 2 || elpairs.n() < 2) {
+        return ZZTo4LepIdxs;
+    }
+
+    int mup = -1, mun = -1;
+    if(!FindBest_ZToLPLN(mupairs, std::vector<char>(mupairs.n(), 0), mup, mun)) {
+        return ZZTo4LepIdxs;
+    }
+
+    // Electrons overlapping with the Z muons are flagged once instead of in every pair
+    const DressedLeptons& mus = mupairs.leps;
+    const DressedLeptons& els = elpairs.leps;
+    std::vector<char> veto(els.n, 0);
+    for(std::size_t i=0; i<els.n; i++) {
+        veto[i] = ROOT::Math::VectorUtil::DeltaR(els.p4[i], mus.p4[mup]) < 0.02 ||
+                  ROOT::Math::VectorUtil::DeltaR(els.p4[i], mus.p4[mun]) < 0.02;
+    }
+
+    int elp = -1, eln = -1;
+    if(!FindBest_ZToLPLN(elpairs, veto, elp, eln)) {
+        return ZZTo4LepIdxs;
+    }
+
+    ZZTo4LepIdxs.push_back(mup);
+    ZZTo4LepIdxs.push_back(mun);
+    ZZTo4LepIdxs.push_back(elp);
+    ZZTo4LepIdxs.push_back(eln);
+
+    return ZZTo4LepIdxs;
+}
+
+
+// Define a function to perform Higgs Analysis and calculate the invariant mass of four leptons
+double Analysis_HTo2Mu2El(const LeptonPairTable& mupairs, int zmup, int zmun,
+                          const LeptonPairTable& elpairs, int zelp, int zeln) {
+
+    double zmu_m = mupairs.M(zmup, zmun);
+    double zel_m = elpairs.M(zelp, zeln);
+
+    double z_m = 91.19;
+    double zz_m = -1;
+
+    if( std::abs(z_m - zmu_m) < std::abs(z_m - zel_m) ) {
+        zz_m = Analysis_HTo4Lep(mupairs, zmup, zmun, elpairs, zelp, zeln);
+    }
+    else {
+        zz_m = Analysis_HTo4Lep(elpairs, zelp, zeln, mupairs, zmup, zmun);
+    }
+
+    return zz_m;
+}
@@ -0,0 +1,64 @@
+import os
+
+import ROOT
+from ROOT import RDataFrame
+
+import cpp_utils
+import file_stager
+import selections
+
+
+# Runs the analysis graph on a Dask cluster through the distributed RDataFrame. The workers
+# import this module, so the repository has to be on their PYTHONPATH, as it is for a local
+# cluster or a multi-node cluster sharing the checkout
+DASK_LOCAL_WORKERS = int(os.environ.get("HTO4L_DASK_WORKERS", os.cpu_count() or 1))
+
+# Tasks per worker, more partitions balance the load between files of different sizes
+DASK_PARTITIONS_PER_WORKER = 4
+
+
+def make_dask_client(scheduler_address: str = None, n_workers: int = DASK_LOCAL_WORKERS):
+
+    # An existing scheduler for the multi-node cluster, otherwise a local cluster for testing
+    from dask.distributed import Client, LocalCluster
+
+    if scheduler_address is not None:
+        return Client(scheduler_address)
+    return Client(LocalCluster(n_workers=n_workers, threads_per_worker=1, processes=True))
+
+
+def setup_worker(lumi_json_paths: list):
+
+    # The kernels are loaded once per worker process and the lumi masks are loaded in the
+    # same order as on the client, so the mask indices in the Filter expressions agree.
+    # A worker without the certification file would have no mask behind the index, so it fails instead
+    if not hasattr(ROOT, "PairLeptons"):
+        cpp_utils.cpp_utils()
+    for mask_idx, lumi_json_path in enumerate(lumi_json_paths):
+        if selections.load_lumi_mask(lumi_json_path, required=True) != mask_idx:
+            raise RuntimeError(f"Lumi mask {lumi_json_path} got a different index on the worker than on the client")
+
+
+def initialize_workers():
+    # Called after the lumi masks of the run are loaded on the client
+    ROOT.RDF.Experimental.Distributed.initialize(setup_worker, list(selections.LOADED_LUMI_JSON_PATHS))
+
+
+def make_dataframe(input_file, dask_client=None):
+
+    # The local dataframe unless a Dask client is given
+    if dask_client is None:
+        return RDataFrame("Events", input_file)
+
+    initialize_workers()
+    input_files = file_stager.list_input_files(input_file)
+    n_workers = max(len(dask_client.scheduler_info()["workers"]), 1)
+    return ROOT.RDF.Experimental.Distributed.Dask.RDataFrame("Events", input_files, daskclient=dask_client,
+                                                             npartitions=n_workers * DASK_PARTITIONS_PER_WORKER)
+
+
+def book_cutflow(df, dask_client=None):
+    # The distributed backends have no Report, the cut flow is only printed for local runs
+    if dask_client is not None:
+        return None
+    return df.Report()
@@ -0,0 +1,267 @@
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import subprocess
+
+import ROOT
+
+import utils
+
+
+# Local copies of the remote input files, fetched ahead of the file being analysed and evicted
+# least recently used first once the cache directory outgrows its size limit
+STAGE_CACHE_DIR = os.environ.get("HTO4L_STAGE_DIR",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), ".stage_cache"))
+STAGE_CACHE_LIMIT_GB = float(os.environ.get("HTO4L_STAGE_LIMIT_GB", "50"))
+
+# Files fetched ahead of the one being analysed
+STAGE_PREFETCH = 2
+
+
+def local_path(url: str) -> str:
+    # file:// inputs stand in for the remote server, e.g. when testing against a local directory
+    return url[len("file://"):] if url.startswith("file://") else url
+
+
+def split_xrootd_url(url: str):
+    # root://eospublic.cern.ch//eos/opendata/... -> (root://eospublic.cern.ch, /eos/opendata/...)
+    server, path = url[len("root://"):].split("/", 1)
+    return f"root://{server}", path if path.startswith("/") else f"/{path}"
+
+
+def list_xrootd_dir(server: str, path: str) -> list:
+    result = subprocess.run(["xrdfs", server, "ls", path], capture_output=True, text=True, check=True)
+    return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+
+def stat_xrootd_file(server: str, path: str) -> dict:
+    # "Size:   2269418402" and "MTime:  2021-07-19 20:18:43" lines among the other fields
+    result = subprocess.run(["xrdfs", server, "stat", path], capture_output=True, text=True, check=True)
+    return parse_xrootd_stat(result.stdout)
+
+
+def parse_xrootd_stat(stat_output: str) -> dict:
+    fields = {}
+    for line in stat_output.splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            fields[key.strip()] = value.strip()
+    if "Size" not in fields or "MTime" not in fields:
+        raise RuntimeError(f"Unexpected xrdfs stat output: {stat_output!r}")
+    return {"size": int(fields["Size"]), "mtime": fields["MTime"]}
+
+
+def file_identity(url: str) -> dict:
+
+    # Size and modification time from one stat on the server, without opening the file with ROOT,
+    # so a file rewritten under the same path gets another identity
+    if url.startswith("root://"):
+        server, path = split_xrootd_url(url)
+        return {"path": url, **stat_xrootd_file(server, path)}
+    stat = os.stat(local_path(url))
+    return {"path": url, "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def list_input_files(input_glob: str) -> list:
+
+    # Expands the input glob of an analyser into its files, in the order RDataFrame reads them
+    if not input_glob.startswith("root://"):
+        scheme = "file://" if input_glob.startswith("file://") else ""
+        return [f"{scheme}{path}" for path in sorted(glob.glob(local_path(input_glob)))]
+
+    # The wildcards can be in any directory level, each level is listed on the server
+    server, path = split_xrootd_url(input_glob)
+    paths = [""]
+    for component in path.strip("/").split("/"):
+        if glob.has_magic(component):
+            paths = [entry for parent in paths for entry in list_xrootd_dir(server, f"{parent}/")
+                     if fnmatch.fnmatch(os.path.basename(entry.rstrip("/")), component)]
+        else:
+            paths = [f"{parent}/{component}" for parent in paths]
+
+    return [f"{server}/{path}" for path in sorted(paths)]
+
+
+def copy_command(url: str, destination: str) -> list:
+    if url.startswith("root://"):
+        return ["xrdcp", "--silent", "--force", url, destination]
+    return ["cp", local_path(url), destination]
+
+
+class FileStager:
+
+    # The copies run as separate processes, so fetching the next files overlaps with the
+    # event loop of the current one without waiting on the python interpreter
+    def __init__(self, cache_dir: str = STAGE_CACHE_DIR, limit_gb: float = STAGE_CACHE_LIMIT_GB,
+                 prefetch: int = STAGE_PREFETCH):
+        self.cache_dir = cache_dir
+        self.limit_bytes = int(limit_gb * 1024**3)
+        self.prefetch = prefetch
+        self.pending = {}
+        self.in_use = set()
+        self.identities = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def staged_path(self, url: str) -> str:
+
+        # Keyed by the size and modification time of the remote file as well, so a file replaced
+        # under the same name is fetched again. The identity is looked up once per run and file
+        if url not in self.identities:
+            self.identities[url] = file_identity(url)
+        identity_hash = hashlib.sha256(json.dumps(self.identities[url], sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{identity_hash}_{os.path.basename(url)}")
+
+    def fetch(self, url: str):
+        staged_path = self.staged_path(url)
+        if url in self.pending or os.path.exists(staged_path):
+            return
+        tmp_path = f"{staged_path}.{os.getpid()}.tmp"
+        self.pending[url] = (subprocess.Popen(copy_command(url, tmp_path)), tmp_path)
+
+    def acquire(self, url: str) -> str:
+
+        self.fetch(url)
+        staged_path = self.staged_path(url)
+        if url in self.pending:
+            process, tmp_path = self.pending.pop(url)
+            if process.wait() != 0:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise RuntimeError(f"Staging {url} failed with exit code {process.returncode}")
+            os.replace(tmp_path, staged_path)
+
+        # The modification time marks the last use for the eviction order
+        os.utime(staged_path)
+        self.in_use.add(staged_path)
+        self.evict()
+        return staged_path
+
+    def release(self, staged_path: str):
+        self.in_use.discard(staged_path)
+
+    def close(self):
+
+        # Stops the copies still running, e.g. when an analysis failed, and removes their partial files
+        for process, tmp_path in self.pending.values():
+            process.terminate()
+            process.wait()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.pending.clear()
+        self.in_use.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def copy_running(self, tmp_path: str) -> bool:
+
+        # Temporary files are named <staged path>.<pid>.tmp by the process copying them
+        if tmp_path in (pending_tmp_path for _, pending_tmp_path in self.pending.values()):
+            return True
+        pid = tmp_path.rsplit(".", 2)[-2]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def evict(self):
+
+        # Copies in progress count towards the limit, the ones left behind by stopped processes are removed
+        staged_files = []
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if not name.endswith(".tmp"):
+                    staged_files.append(path)
+                elif self.copy_running(path):
+                    total_bytes += os.path.getsize(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                # Moved into place or removed by another process meanwhile
+                pass
+
+        # Least recently used files first, skipping the ones being read
+        staged_files.sort(key=os.path.getmtime)
+        total_bytes += sum(os.path.getsize(path) for path in staged_files)
+        for path in staged_files:
+            if total_bytes <= self.limit_bytes:
+                break
+            if path in self.in_use:
+                continue
+            total_bytes -= os.path.getsize(path)
+            os.remove(path)
+            print(f"Evicted staged file {path}")
+
+    def staged_files(self, urls: list):
+
+        # Yields the local path of every file while the next ones are being fetched
+        for idx, url in enumerate(urls):
+            for next_url in urls[idx + 1:idx + 1 + self.prefetch]:
+                self.fetch(next_url)
+            staged_path = self.acquire(url)
+            try:
+                yield url, staged_path
+            finally:
+                self.release(staged_path)
+
+
+def part_path(path: str, part_idx: int) -> str:
+    # 4mu_output.root -> 4mu_output_part3.root, snapshot paths have no extension
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_part{part_idx}{extension}"
+
+
+def merge_histogram_files(part_files: list, output_file: str, remove_parts: bool = True):
+
+    # Histograms with the same name are added and trees are chained, keeping the key order of the first part
+    merger = ROOT.TFileMerger(False)
+    merger.OutputFile(output_file, "RECREATE")
+    for part_file in part_files:
+        merger.AddFile(part_file)
+    if not merger.Merge():
+        raise RuntimeError(f"Merging {len(part_files)} parts into {output_file} failed")
+    if remove_parts:
+        for part_file in part_files:
+            os.remove(part_file)
+    print(f"Merged {len(part_files)} parts into {output_file}")
+
+
+@utils.time_eval
+def analyse_staged(analyse, input_glob: str, output_file: str, lumi_json_path: str = "", save_snapshot_path=None,
+                   stager: FileStager = None, **kwargs):
+
+    # Runs one of the analyse_*_data functions per staged file and merges the parts, e.g.
+    # analyse_staged(analyse_4mu_data, "root://eospublic.cern.ch//eos/.../*/*.root", "4mu_output.root", ...)
+    stager = stager if stager is not None else FileStager()
+    urls = list_input_files(input_glob)
+    if not urls:
+        raise RuntimeError(f"No input files match {input_glob}")
+    part_files, part_snapshots = [], []
+    try:
+        for part_idx, (url, staged_path) in enumerate(stager.staged_files(urls)):
+            part_snapshot = part_path(save_snapshot_path, part_idx) if save_snapshot_path is not None else None
+            analyse(staged_path, part_path(output_file, part_idx), lumi_json_path, part_snapshot, **kwargs)
+            part_files.append(part_path(output_file, part_idx))
+            if part_snapshot is not None:
+                part_snapshots.append(part_snapshot)
+    finally:
+        stager.close()
+
+    merge_histogram_files(part_files, output_file)
+    if kwargs.get("pick_events"):
+        merge_histogram_files([utils.pick_events_path(part_file) for part_file in part_files],
+                              utils.pick_events_path(output_file))
+    if save_snapshot_path is not None:
+        utils.merge_event_snapshots(part_snapshots, save_snapshot_path)
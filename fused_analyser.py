@@ -0,0 +1,321 @@
+import argparse
+import importlib
+
+import ROOT
+from ROOT import RDataFrame
+
+import cpp_utils
+import distributed_backend
+import file_stager
+import histogram_tables
+import selections
+import sharding
+import skim_cache
+import utils
+
+# The analyser module names start with a digit, so they are imported by name
+analyser_4mu = importlib.import_module("4mu_analyser")
+analyser_4e = importlib.import_module("4e_analyser")
+analyser_2mu2e = importlib.import_module("2mu_2e_analyser")
+
+
+# Trigger paths and booking function of every channel
+CHANNELS = {
+    "4mu": {"hlt_paths": selections.MUON_HLT_PATHS, "book": analyser_4mu.book_4mu_channel},
+    "4e": {"hlt_paths": selections.ELECTRON_HLT_PATHS, "book": analyser_4e.book_4e_channel},
+    "2mu2e": {"hlt_paths": selections.MUEL_HLT_PATHS, "book": analyser_2mu2e.book_2mu2e_channel},
+}
+
+# Primary datasets with their certification file and the channels analysed on them.
+# Outputs follow the per-channel analysers: {channel}_output_file_{tag}.root and {channel}_{short}
+EOS_NANOAOD = "root://eospublic.cern.ch//eos/opendata/cms"
+DATASETS = [
+    {"input": f"{EOS_NANOAOD}/Run2016H/DoubleMuon/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "doublemuon_2016H", "short": "doublemu_2016H", "cert": "muon_2016_cert.txt",
+     "channels": ["4mu", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016G/DoubleMuon/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v2/*/*.root",
+     "tag": "doublemuon_2016G", "short": "doublemu_2016G", "cert": "muon_2016_cert.txt",
+     "channels": ["4mu", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016H/SingleMuon/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "singlemuon_2016H", "short": "singlemu_2016H", "cert": "muon_2016_cert.txt",
+     "channels": ["4mu", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016G/SingleMuon/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "singlemuon_2016G", "short": "singlemu_2016G", "cert": "muon_2016_cert.txt",
+     "channels": ["4mu", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016H/DoubleEG/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "doubleelectron_2016H", "short": "doubleel_2016H", "cert": "all_2016_cert.txt",
+     "channels": ["4e", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016G/DoubleEG/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "doubleelectron_2016G", "short": "doubleel_2016G", "cert": "all_2016_cert.txt",
+     "channels": ["4e", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016H/SingleElectron/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "singleelectron_2016H", "short": "singleel_2016H", "cert": "all_2016_cert.txt",
+     "channels": ["4e", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016G/SingleElectron/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "singleelectron_2016G", "short": "singleel_2016G", "cert": "all_2016_cert.txt",
+     "channels": ["4e", "2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016H/MuonEG/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "mueg_2016H", "short": "mueg_2016H", "cert": "all_2016_cert.txt",
+     "channels": ["2mu2e"]},
+    {"input": f"{EOS_NANOAOD}/Run2016G/MuonEG/NANOAOD/UL2016_MiniAODv2_NanoAODv9-v1/*/*.root",
+     "tag": "mueg_2016G", "short": "mueg_2016G", "cert": "all_2016_cert.txt",
+     "channels": ["2mu2e"]},
+]
+
+
+def channel_outputs_for(dataset: dict) -> dict:
+    return {channel: (f"{channel}_output_file_{dataset['tag']}.root", f"{channel}_{dataset['short']}")
+            for channel in dataset["channels"]}
+
+
+def book_fused_channels(df_s1, channel_outputs: dict, shared_hlt_paths: list, profile: dict = None,
+                        histo_profile: str = "full", pick_events: bool = False) -> dict:
+
+    booked = {}
+    for channel, (output_file, save_snapshot_path) in channel_outputs.items():
+
+        # The shared node is triggered on the union of the channel paths,
+        # so only channels with a narrower trigger selection need their own filter
+        hlt_paths = CHANNELS[channel]["hlt_paths"]
+        df_channel = utils.set_stage(df_s1, "Step 1 - Preselection")
+        if set(hlt_paths) != set(shared_hlt_paths):
+            df_channel = df_channel.Filter(selections.hlt_selstr(selections.order_hlt_paths(hlt_paths, profile)),
+                                           f"Step 1 - HLT {channel}")
+
+        histograms = []
+        df_cand = CHANNELS[channel]["book"](df_channel, histograms, histo_profile)
+
+        snapshot = None
+        if save_snapshot_path is not None:
+            snapshot = utils.book_event_snapshot(df_cand, save_snapshot_path, utils.SNAPSHOT_COLUMNS)
+
+        picked = None
+        if pick_events:
+            picked = utils.book_pick_events(df_cand, output_file)
+
+        booked[channel] = (histograms, snapshot, picked)
+
+    return booked
+
+
+def write_fused_outputs(booked: dict, channel_outputs: dict):
+
+    for channel, (output_file, save_snapshot_path) in channel_outputs.items():
+        histograms, snapshot, picked = booked[channel]
+
+        utils.write_histograms(histograms, output_file)
+        if picked is not None:
+            utils.write_pick_events(picked, output_file)
+
+        if snapshot is not None:
+            utils.write_event_snapshot(snapshot, save_snapshot_path, utils.SNAPSHOT_COLUMNS)
+
+
+@utils.time_eval
+def analyse_fused_data(input_file, channel_outputs: dict, lumi_json_path="", profile_filters=False, time_nodes=False,
+                       histo_profile="full", use_skim_cache=False, dask_client=None, pick_events=False):
+
+    # channel_outputs maps each channel to its (output_file, save_snapshot_path)
+    lumimask_idx = selections.load_lumi_mask(lumi_json_path)
+
+    shared_hlt_paths = selections.merge_hlt_paths(*[CHANNELS[channel]["hlt_paths"]
+                                                    for channel in channel_outputs])
+    lumi_selstr = selections.lumi_mask_selstr(lumimask_idx)
+
+    # Optionally read a local skim of the preselected events and used columns, built on the first run
+    if use_skim_cache:
+        input_file = skim_cache.cached_input(input_file, shared_hlt_paths, lumi_json_path)
+
+    profile = None
+    if profile_filters:
+        profile = selections.profile_preselection(input_file, shared_hlt_paths, lumi_selstr)
+
+    # Lumi mask, HLT, primary vertex and object selection are shared by all channels
+    df = distributed_backend.make_dataframe(input_file, dask_client)
+    profiler = None
+    if time_nodes:
+        if dask_client is not None:
+            raise ValueError("Node timing is only available for local runs")
+        df, profiler = utils.profile_nodes(df)
+    print(f"Analysing channels {', '.join(channel_outputs)} in path: {input_file}")
+    n_events = df.Count()
+    cutflow = distributed_backend.book_cutflow(df, dask_client)
+    df_s1 = selections.apply_preselection(df, shared_hlt_paths, lumi_selstr, profile)
+    df_s1 = selections.define_tight_muons(df_s1)
+    df_s1 = selections.define_tight_electrons(df_s1)
+
+    booked = book_fused_channels(df_s1, channel_outputs, shared_hlt_paths, profile, histo_profile, pick_events)
+
+    # The first result accessed runs the single event loop for every channel
+    write_fused_outputs(booked, channel_outputs)
+    utils.print_cutflow(input_file, n_events, cutflow)
+    if profiler is not None:
+        # One report for the shared graph, next to the output of the first channel
+        profiler.write_report(next(iter(channel_outputs.values()))[0])
+
+
+@utils.time_eval
+def analyse_fused_staged(input_glob, channel_outputs: dict, lumi_json_path="", stager=None, **kwargs):
+
+    # One fused event loop per staged file, while the next files are fetched, then the parts
+    # of every channel are merged into its output
+    stager = stager if stager is not None else file_stager.FileStager()
+    urls = file_stager.list_input_files(input_glob)
+    if not urls:
+        raise RuntimeError(f"No input files match {input_glob}")
+    part_outputs = []
+    try:
+        for part_idx, (url, staged_path) in enumerate(stager.staged_files(urls)):
+            outputs = {channel: (file_stager.part_path(output_file, part_idx),
+                                 file_stager.part_path(save_snapshot_path, part_idx) if save_snapshot_path is not None else None)
+                       for channel, (output_file, save_snapshot_path) in channel_outputs.items()}
+            analyse_fused_data(staged_path, outputs, lumi_json_path, **kwargs)
+            part_outputs.append(outputs)
+    finally:
+        stager.close()
+
+    for channel, (output_file, save_snapshot_path) in channel_outputs.items():
+        file_stager.merge_histogram_files([outputs[channel][0] for outputs in part_outputs], output_file)
+        if kwargs.get("pick_events"):
+            file_stager.merge_histogram_files([utils.pick_events_path(outputs[channel][0]) for outputs in part_outputs],
+                                              utils.pick_events_path(output_file))
+        if save_snapshot_path is not None:
+            utils.merge_event_snapshots([outputs[channel][1] for outputs in part_outputs], save_snapshot_path)
+
+
+@utils.time_eval
+def analyse_campaign(datasets: list, histo_profile="full", use_skim_cache=False, pick_events=False,
+                     profile_filters=False, time_nodes=False):
+
+    # Every certification file gets its own lumi mask index, shared by the samples using it
+    lumimask_idxs = {}
+    for dataset in datasets:
+        if dataset["cert"] not in lumimask_idxs:
+            lumimask_idxs[dataset["cert"]] = selections.load_lumi_mask(dataset["cert"])
+
+    shared_hlt_paths = selections.merge_hlt_paths(*[CHANNELS[channel]["hlt_paths"]
+                                                    for dataset in datasets
+                                                    for channel in dataset["channels"]])
+
+    # Every dataset is skimmed with its own certification file and the shared trigger paths
+    if use_skim_cache:
+        datasets = [dict(dataset, input=skim_cache.cached_input(dataset["input"], shared_hlt_paths, dataset["cert"]))
+                    for dataset in datasets]
+
+    # One sample per primary dataset and era, all read by a single dataframe
+    spec = ROOT.RDF.Experimental.RDatasetSpec()
+    for sample_idx, dataset in enumerate(datasets):
+        meta = ROOT.RDF.Experimental.RMetaData()
+        meta.Add("sample_idx", sample_idx)
+        meta.Add("lumimask_idx", lumimask_idxs[dataset["cert"]])
+        spec.AddSample(ROOT.RDF.Experimental.RSample(dataset["tag"], "Events", dataset["input"], meta))
+
+    # The lumi mask of every sample is picked per event. The preselection is profiled on a sample
+    # of the first dataset, with its mask in place of the per-sample one
+    lumi_selstr = "is_valid_in(lumimask_idx, run, luminosityBlock)"
+    profile = None
+    if profile_filters:
+        profile = selections.profile_preselection(datasets[0]["input"], shared_hlt_paths,
+                                                  f"is_valid_in({lumimask_idxs[datasets[0]['cert']]}, run, luminosityBlock)")
+
+    df = RDataFrame(spec)
+    print(f"Analysing campaign of {len(datasets)} datasets in a single event loop")
+    n_events = df.Count()
+    cutflow = df.Report()
+    df = df.DefinePerSample("sample_idx", 'rdfsampleinfo_.GetI("sample_idx")')
+    df = df.DefinePerSample("lumimask_idx", 'rdfsampleinfo_.GetI("lumimask_idx")')
+    profiler = None
+    if time_nodes:
+        df, profiler = utils.profile_nodes(df)
+
+    df_s1 = selections.apply_preselection(df, shared_hlt_paths, lumi_selstr, profile)
+    df_s1 = selections.define_tight_muons(df_s1)
+    df_s1 = selections.define_tight_electrons(df_s1)
+
+    # Route every sample to the output files of its dataset
+    booked = []
+    for sample_idx, dataset in enumerate(datasets):
+        channel_outputs = channel_outputs_for(dataset)
+        df_sample = df_s1.Filter(f"sample_idx == {sample_idx}", f"Sample {dataset['tag']}")
+        booked.append((book_fused_channels(df_sample, channel_outputs, shared_hlt_paths, profile, histo_profile,
+                                           pick_events),
+                       channel_outputs))
+
+    # Everything is booked, so the graph is jitted once and the first write runs the event loop
+    for sample_booked, channel_outputs in booked:
+        write_fused_outputs(sample_booked, channel_outputs)
+    utils.print_cutflow(", ".join(dataset["tag"] for dataset in datasets), n_events, cutflow)
+    if profiler is not None:
+        # One report for the whole campaign, next to the output of the first channel of the first dataset
+        profiler.write_report(next(iter(channel_outputs_for(datasets[0]).values()))[0])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fused 4mu, 4e and 2mu2e analysis of the 2016 datasets")
+    parser.add_argument("--campaign", action="store_true",
+                        help="Run all datasets and eras as samples of a single dataframe")
+    parser.add_argument("--profile-filters", action="store_true",
+                        help="Order the preselection by the rejection and cost measured on a sample of each dataset")
+    parser.add_argument("--time-nodes", action="store_true",
+                        help="Write a per-node timing report next to the histogram output of each dataset")
+    parser.add_argument("--histo-profile", default="full", choices=histogram_tables.HISTO_PROFILES,
+                        help="Book only the histograms of this profile, minimal keeps the Z and four lepton masses")
+    parser.add_argument("--skim-cache", action="store_true",
+                        help="Read local skims of the preselected events, built on the first run of each input")
+    parser.add_argument("--stage", action="store_true",
+                        help="Copy the input files to a local cache ahead of analysing them, one file at a time")
+    parser.add_argument("--dask-scheduler", default=None,
+                        help="Run each dataset on the Dask cluster of this scheduler address")
+    parser.add_argument("--dask-workers", type=int, default=0,
+                        help="Run each dataset on a local Dask cluster with this many workers")
+    parser.add_argument("--sharded", action="store_true",
+                        help="Analyse groups of input files as shards recorded in a manifest, a rerun only "
+                             "analyses new, changed or failed shards")
+    parser.add_argument("--files-per-shard", type=int, default=sharding.FILES_PER_SHARD,
+                        help="Input files analysed together in one shard")
+    parser.add_argument("--shard-workers", type=int, default=1,
+                        help="Shards analysed concurrently, each in its own process")
+    parser.add_argument("--pick-events", action="store_true",
+                        help="Write all NanoAOD branches of the Higgs candidates next to the histogram output")
+    args = parser.parse_args()
+    if sum([args.campaign, args.stage, args.sharded]) > 1:
+        parser.error("--campaign, --stage and --sharded cannot be combined")
+
+    # The distributed dataframe reads every file of a dataset in parallel tasks, so it replaces
+    # both the campaign dataframe and the staging of the files
+    dask_client = None
+    if args.dask_scheduler is not None or args.dask_workers > 0:
+        if args.campaign or args.stage or args.sharded:
+            parser.error("--dask-scheduler and --dask-workers cannot be combined with --campaign, --stage or --sharded")
+        if args.time_nodes:
+            parser.error("--time-nodes is only available for local runs")
+        dask_client = distributed_backend.make_dask_client(args.dask_scheduler,
+                                                           args.dask_workers or distributed_backend.DASK_LOCAL_WORKERS)
+
+    ROOT.EnableImplicitMT()
+
+    cpp_utils.cpp_utils()
+
+    if args.campaign:
+        analyse_campaign(DATASETS, args.histo_profile, args.skim_cache, args.pick_events, args.profile_filters,
+                         args.time_nodes)
+    elif args.sharded:
+        for dataset in DATASETS:
+            sharding.run_shards("fused_analyser", "analyse_fused_data", dataset["input"], channel_outputs_for(dataset),
+                                dataset["cert"], True, args.files_per_shard, args.shard_workers,
+                                profile_filters=args.profile_filters, time_nodes=args.time_nodes,
+                                histo_profile=args.histo_profile, use_skim_cache=args.skim_cache,
+                                pick_events=args.pick_events)
+    elif args.stage:
+        with file_stager.FileStager() as stager:
+            for dataset in DATASETS:
+                analyse_fused_staged(dataset["input"], channel_outputs_for(dataset), dataset["cert"], stager,
+                                     profile_filters=args.profile_filters, time_nodes=args.time_nodes,
+                                     histo_profile=args.histo_profile, use_skim_cache=args.skim_cache,
+                                     pick_events=args.pick_events)
+    else:
+        for dataset in DATASETS:
+            analyse_fused_data(dataset["input"], channel_outputs_for(dataset), dataset["cert"],
+                               args.profile_filters, args.time_nodes, args.histo_profile, args.skim_cache, dask_client,
+                               args.pick_events)
@@ -0,0 +1,319 @@
+import ROOT
+
+import utils
+
+
+# Histogram profiles from the smallest to the largest, every profile also books
+# the histograms of the profiles before it
+#   minimal    - Z and four lepton masses only, for production runs
+#   validation - adds the object and candidate multiplicities and the pt, eta, phi spectra
+#   full       - every histogram, including the trigger level and identification variables
+HISTO_PROFILES = ["minimal", "validation", "full"]
+
+# Every histogram is (name, title, nbins, xlow, xhigh, column, stage, profile), where stage is
+# the dataframe node it is filled on:
+#   step1 - after the lumi, HLT and primary vertex preselection
+#   step2 - after the good lepton multiplicity requirement
+#   step3 - after at least one Z candidate is found
+#   step4 - after two non-overlapping Z candidates are found
+#   higgs - Higgs candidates passing the four lepton selection
+# The histograms are written in the order of the table
+
+# 4mu channel, booked by 4mu_analyser.book_4mu_channel
+HISTOS_4MU = [
+    ("h_muhlt_n", "Muon N; N; Events", 20, 0, 20, "nMuon", "step1", "full"),
+    ("h_muhlt_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "Muon_pt", "step1", "full"),
+    ("h_muhlt_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "Muon_eta", "step1", "full"),
+    ("h_muhlt_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "Muon_phi", "step1", "full"),
+    ("h_muhlt_dxy", "Muon d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "Muon_dxy", "step1", "full"),
+    ("h_muhlt_dz", "Muon d_{z}; d_{z}; Events", 300, -1.5, 1.5, "Muon_dz", "step1", "full"),
+    ("h_muhlt_charge", "Muon charge; charge; Events", 10, -5, 5, "Muon_charge", "step1", "full"),
+    ("h_muhlt_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "Muon_fsrPhotonIdx", "step1", "full"),
+    ("h_muhlt_isglobal", "Muon is Global; is global; Events", 10, -1, 9, "Muon_isGlobal", "step1", "full"),
+    ("h_muhlt_isstandalone", "Muon is Standalone; is standalone; Events", 10, -1, 9, "Muon_isStandalone", "step1", "full"),
+    ("h_muhlt_istracker", "Muon is Tracker; is tracker; Events", 10, -1, 9, "Muon_isTracker", "step1", "full"),
+    ("h_muhlt_ntrackerlayers", "Muon hit count in tracker layers; number of tracker layers; Events", 23, -1, 22, "Muon_nTrackerLayers", "step1", "full"),
+    ("h_muhlt_highptid", "Muon cut based high pT identification; high pt id; Events", 10, -1, 9, "Muon_highPtId", "step1", "full"),
+    ("h_muhlt_looseid", "Muon loose idenitifcation; tight id; Events", 10, -1, 9, "Muon_looseId", "step1", "full"),
+    ("h_muhlt_mediumid", "Muon medium idenitifcation; tight id; Events", 10, -1, 9, "Muon_mediumId", "step1", "full"),
+    ("h_muhlt_tightid", "Muon tight idenitifcation; tight id; Events", 10, -1, 9, "Muon_tightId", "step1", "full"),
+    ("h_muhlt_pfisoid", "Muon PF isolation idenitifcation; pf iso id; Events", 10, -1, 9, "Muon_pfIsoId", "step1", "full"),
+    ("h_muhlt_puppiisoid", "Muon PUPPI isolation idenitifcation; puppi iso id; Events", 10, -1, 9, "Muon_puppiIsoId", "step1", "full"),
+    ("h_muhlt_relpfiso03", "Muon relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "Muon_pfRelIso03_all", "step1", "full"),
+    ("hprefilt_mutight_n", "Muon N; N; Events", 20, 0, 20, "MuTight_n", "step1", "validation"),
+    ("hpostfilt_mutight_n", "Muon N; N; Events", 20, 0, 20, "MuTight_n", "step2", "validation"),
+    ("h_mutight_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "MuTight_pt", "step1", "validation"),
+    ("h_mutight_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "MuTight_eta", "step1", "validation"),
+    ("h_mutight_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "MuTight_phi", "step1", "validation"),
+    ("h_mutight_dxy", "Muon d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "MuTight_dxy", "step1", "full"),
+    ("h_mutight_dz", "Muon d_{z}; d_{z}; Events", 300, -1.5, 1.5, "MuTight_dz", "step1", "full"),
+    ("h_mutight_charge", "Muon charge; charge; Events", 10, -5, 5, "MuTight_charge", "step1", "full"),
+    ("h_mutight_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "MuTight_fsrPhotonIdx", "step1", "full"),
+    ("h_mutight_cleanmask", "Muon clean mask; clean mask; Events", 10, -1, 9, "MuTight_cleanmask", "step1", "full"),
+    ("h_mutight_isglobal", "Muon is Global; is global; Events", 10, -1, 9, "MuTight_isGlobal", "step1", "full"),
+    ("h_mutight_isstandalone", "Muon is Standalone; is standalone; Events", 10, -1, 9, "MuTight_isStandalone", "step1", "full"),
+    ("h_mutight_istracker", "Muon is Tracker; is tracker; Events", 10, -1, 9, "MuTight_isTracker", "step1", "full"),
+    ("h_mutight_ntrackerlayers", "Muon hit count in tracker layers; number of tracker layers; Events", 23, -1, 22, "MuTight_nTrackerLayers", "step1", "full"),
+    ("h_mutight_highptid", "Muon cut based high pT identification; high pt id; Events", 10, -1, 9, "MuTight_highPtId", "step1", "full"),
+    ("h_mutight_looseid", "Muon loose idenitifcation; tight id; Events", 10, -1, 9, "MuTight_looseId", "step1", "full"),
+    ("h_mutight_mediumid", "Muon medium idenitifcation; tight id; Events", 10, -1, 9, "MuTight_mediumId", "step1", "full"),
+    ("h_mutight_tightid", "Muon tight idenitifcation; tight id; Events", 10, -1, 9, "MuTight_tightId", "step1", "full"),
+    ("h_mutight_pfisoid", "Muon PF isolation idenitifcation; pf iso id; Events", 10, -1, 9, "MuTight_pfIsoId", "step1", "full"),
+    ("h_mutight_puppiisoid", "Muon PUPPI isolation idenitifcation; puppi iso id; Events", 10, -1, 9, "MuTight_puppiIsoId", "step1", "full"),
+    ("h_mutight_relpfiso03", "Muon relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "MuTight_pfRelIso03_all", "step1", "full"),
+    ("hprefilt_n_ZToMuMu", "Z #rightarrow #mu #mu N; N; Events", 15, -1, 14, "n_ZToMuMu", "step2", "validation"),
+    ("hpostfilt_n_ZToMuMu", "Z #rightarrow #mu #mu N; N; Events", 15, -1, 14, "n_ZToMuMu", "step3", "validation"),
+    ("h_mass_ZToMuMu", "M; M (GeV/c); Events", 160, -10, 150, "M_ZToMuMu", "step3", "minimal"),
+    ("h_allZmumu_n", "Muon N; N; Events", 20, 0, 20, "MuTight_n", "step3", "validation"),
+    ("h_allZmumu_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "MuTight_pt", "step3", "validation"),
+    ("h_allZmumu_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "MuTight_eta", "step3", "validation"),
+    ("h_allZmumu_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "MuTight_phi", "step3", "validation"),
+    ("h_allZmumu_charge", "Muon charge; charge; Events", 10, -5, 5, "MuTight_charge", "step3", "full"),
+    ("h_allZmumu_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "MuTight_fsrPhotonIdx", "step3", "full"),
+    ("h_allZZTo4MuIdxs_n", "Muon N; N; Events", 10, 0, 10, "ZZTo4MuIdxs_n", "step3", "validation"),
+    ("h_z1mupidx", "Muon Index; Index; Events", 20, 0, 20, "z1mupidx", "step4", "full"),
+    ("h_z1mup_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z1mup_pt", "step4", "validation"),
+    ("h_z1mup_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "z1mup_eta", "step4", "validation"),
+    ("h_z1mup_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "z1mup_phi", "step4", "validation"),
+    ("h_z1mup_charge", "Muon charge; charge; Events", 10, -5, 5, "z1mup_charge", "step4", "full"),
+    ("h_z1mup_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "z1mup_fsrPhotonIdx", "step4", "full"),
+    ("h_z1munidx", "Muon Index; Index; Events", 20, 0, 20, "z1munidx", "step4", "full"),
+    ("h_z1mun_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z1mun_pt", "step4", "validation"),
+    ("h_z1mun_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "z1mun_eta", "step4", "validation"),
+    ("h_z1mun_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "z1mun_phi", "step4", "validation"),
+    ("h_z1mun_charge", "Muon charge; charge; Events", 10, -5, 5, "z1mun_charge", "step4", "full"),
+    ("h_z1mun_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "z1mun_fsrPhotonIdx", "step4", "full"),
+    ("h_z1_mass", "M; M (GeV/c); Events", 160, -10, 150, "z1_mass", "step4", "minimal"),
+    ("h_z2mupidx", "Muon Index; Index; Events", 20, 0, 20, "z2mupidx", "step4", "full"),
+    ("h_z2mup_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z2mup_pt", "step4", "validation"),
+    ("h_z2mup_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "z2mup_eta", "step4", "validation"),
+    ("h_z2mup_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "z2mup_phi", "step4", "validation"),
+    ("h_z2mup_charge", "Muon charge; charge; Events", 10, -5, 5, "z2mup_charge", "step4", "full"),
+    ("h_z2mup_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "z2mup_fsrPhotonIdx", "step4", "full"),
+    ("h_z2munidx", "Muon Index; Index; Events", 20, 0, 20, "z2munidx", "step4", "full"),
+    ("h_z2mun_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z2mun_pt", "step4", "validation"),
+    ("h_z2mun_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "z2mun_eta", "step4", "validation"),
+    ("h_z2mun_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "z2mun_phi", "step4", "validation"),
+    ("h_z2mun_charge", "Muon charge; charge; Events", 10, -5, 5, "z2mun_charge", "step4", "full"),
+    ("h_z2mun_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "z2mun_fsrPhotonIdx", "step4", "full"),
+    ("h_z2_mass", "M; M (GeV/c); Events", 160, -10, 150, "z2_mass", "step4", "minimal"),
+    ("h_muon_4MuM", "Muon M; M (GeV/c); Events", 250, 0, 500, "fourlep_mass", "higgs", "minimal"),
+]
+
+# 4e channel, booked by 4e_analyser.book_4e_channel
+HISTOS_4E = [
+    ("h_ehlt_n", "Electron N; N; Events", 20, 0, 20, "nElectron", "step1", "full"),
+    ("h_ehlt_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "Electron_pt", "step1", "full"),
+    ("h_ehlt_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "Electron_eta", "step1", "full"),
+    ("h_ehlt_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "Electron_phi", "step1", "full"),
+    ("h_ehlt_dxy", "Electron d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "Electron_dxy", "step1", "full"),
+    ("h_ehlt_dz", "Electron d_{z}; d_{z}; Events", 300, -1.5, 1.5, "Electron_dz", "step1", "full"),
+    ("h_ehlt_charge", "Electron charge; charge; Events", 10, -5, 5, "Electron_charge", "step1", "full"),
+    ("h_ehlt_mvabdtscore", "Electron MVA BDT Score; Score; Events", 110, -1.1, 1.1, "Electron_mvaFall17V2noIso", "step1", "full"),
+    ("h_ehlt_ismvabdtloose", "Electron MVA BDT WP Loose; is Loose; Events", 10, -5, 5, "Electron_mvaFall17V2noIso_WPL", "step1", "full"),
+    ("h_ehlt_relpfiso03", "Electron relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "Electron_pfRelIso03_all", "step1", "full"),
+    ("hprefilt_eltight_n", "Electron N; N; Events", 20, 0, 20, "ElTight_n", "step1", "validation"),
+    ("hpostfilt_eltight_n", "Electron N; N; Events", 20, 0, 20, "ElTight_n", "step2", "validation"),
+    ("h_eltight_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "ElTight_pt", "step1", "validation"),
+    ("h_eltight_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "ElTight_eta", "step1", "validation"),
+    ("h_eltight_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "ElTight_phi", "step1", "validation"),
+    ("h_eltight_dxy", "Electron d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "ElTight_dxy", "step1", "full"),
+    ("h_eltight_dz", "Electron d_{z}; d_{z}; Events", 300, -1.5, 1.5, "ElTight_dz", "step1", "full"),
+    ("h_eltight_charge", "Electron charge; charge; Events", 10, -5, 5, "ElTight_charge", "step1", "full"),
+    ("h_eltight_mvabdtscore", "Electron MVA BDT Score; Score; Events", 110, -1.1, 1.1, "ElTight_mvaFall17V2noIso", "step1", "full"),
+    ("h_eltight_ismvabdtloose", "Electron MVA BDT WP Loose; is Loose; Events", 10, -5, 5, "ElTight_mvaFall17V2noIso_WPL", "step1", "full"),
+    ("h_eltight_relpfiso03", "Electron relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "ElTight_pfRelIso03_all", "step1", "full"),
+    ("hprefilt_n_ZToElEl", "Z #rightarrow e e; N; Events", 15, -1, 14, "n_ZToElEl", "step2", "validation"),
+    ("hpostfilt_n_ZToElEl", "Z #rightarrow e e; N; Events", 15, -1, 14, "n_ZToElEl", "step3", "validation"),
+    ("h_mass_ZToElEl", "M; M (GeV/c); Events", 160, -10, 150, "M_ZToElEl", "step3", "minimal"),
+    ("h_allZelel_n", "Electron N; N; Events", 20, 0, 20, "ElTight_n", "step3", "validation"),
+    ("h_allZelel_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "ElTight_pt", "step3", "validation"),
+    ("h_allZelel_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "ElTight_eta", "step3", "validation"),
+    ("h_allZelel_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "ElTight_phi", "step3", "validation"),
+    ("h_allZelel_charge", "Electron charge; charge; Events", 10, -5, 5, "ElTight_charge", "step3", "full"),
+    ("h_allZZTo4ElIdxs_n", "Electron N; N; Events", 10, 0, 10, "ZZTo4ElIdxs_n", "step3", "validation"),
+    ("h_z1elpidx", "Electron Index; Index; Events", 20, 0, 20, "z1elpidx", "step4", "full"),
+    ("h_z1elp_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z1elp_pt", "step4", "validation"),
+    ("h_z1elp_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "z1elp_eta", "step4", "validation"),
+    ("h_z1elp_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "z1elp_phi", "step4", "validation"),
+    ("h_z1elp_charge", "Electron charge; charge; Events", 10, -5, 5, "z1elp_charge", "step4", "full"),
+    ("h_z1elnidx", "Electron Index; Index; Events", 20, 0, 20, "z1elnidx", "step4", "full"),
+    ("h_z1eln_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z1eln_pt", "step4", "validation"),
+    ("h_z1eln_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "z1eln_eta", "step4", "validation"),
+    ("h_z1eln_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "z1eln_phi", "step4", "validation"),
+    ("h_z1eln_charge", "Electron charge; charge; Events", 10, -5, 5, "z1eln_charge", "step4", "full"),
+    ("h_z1_mass", "M; M (GeV/c); Events", 160, -10, 150, "z1_mass", "step4", "minimal"),
+    ("h_z2elpidx", "Electron Index; Index; Events", 20, 0, 20, "z2elpidx", "step4", "full"),
+    ("h_z2elp_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z2elp_pt", "step4", "validation"),
+    ("h_z2elp_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "z2elp_eta", "step4", "validation"),
+    ("h_z2elp_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "z2elp_phi", "step4", "validation"),
+    ("h_z2elp_charge", "Electron charge; charge; Events", 10, -5, 5, "z2elp_charge", "step4", "full"),
+    ("h_z2elnidx", "Electron Index; Index; Events", 20, 0, 20, "z2elnidx", "step4", "full"),
+    ("h_z2eln_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "z2eln_pt", "step4", "validation"),
+    ("h_z2eln_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "z2eln_eta", "step4", "validation"),
+    ("h_z2eln_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "z2eln_phi", "step4", "validation"),
+    ("h_z2eln_charge", "Electron charge; charge; Events", 10, -5, 5, "z2eln_charge", "step4", "full"),
+    ("h_z2_mass", "M; M (GeV/c); Events", 160, -10, 150, "z2_mass", "step4", "minimal"),
+    ("h_electron_4ElM", "Electron M; M (GeV/c); Events", 250, 0, 500, "fourlep_mass", "higgs", "minimal"),
+]
+
+# 2mu2e channel, booked by 2mu_2e_analyser.book_2mu2e_channel
+HISTOS_2MU2E = [
+    ("h_muhlt_n", "Muon N; N; Events", 20, 0, 20, "nMuon", "step1", "full"),
+    ("h_muhlt_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "Muon_pt", "step1", "full"),
+    ("h_muhlt_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "Muon_eta", "step1", "full"),
+    ("h_muhlt_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "Muon_phi", "step1", "full"),
+    ("h_muhlt_dxy", "Muon d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "Muon_dxy", "step1", "full"),
+    ("h_muhlt_dz", "Muon d_{z}; d_{z}; Events", 300, -1.5, 1.5, "Muon_dz", "step1", "full"),
+    ("h_muhlt_charge", "Muon charge; charge; Events", 10, -5, 5, "Muon_charge", "step1", "full"),
+    ("h_muhlt_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "Muon_fsrPhotonIdx", "step1", "full"),
+    ("h_muhlt_isglobal", "Muon is Global; is global; Events", 10, -1, 9, "Muon_isGlobal", "step1", "full"),
+    ("h_muhlt_isstandalone", "Muon is Standalone; is standalone; Events", 10, -1, 9, "Muon_isStandalone", "step1", "full"),
+    ("h_muhlt_istracker", "Muon is Tracker; is tracker; Events", 10, -1, 9, "Muon_isTracker", "step1", "full"),
+    ("h_muhlt_ntrackerlayers", "Muon hit count in tracker layers; number of tracker layers; Events", 23, -1, 22, "Muon_nTrackerLayers", "step1", "full"),
+    ("h_muhlt_highptid", "Muon cut based high pT identification; high pt id; Events", 10, -1, 9, "Muon_highPtId", "step1", "full"),
+    ("h_muhlt_looseid", "Muon loose idenitifcation; tight id; Events", 10, -1, 9, "Muon_looseId", "step1", "full"),
+    ("h_muhlt_mediumid", "Muon medium idenitifcation; tight id; Events", 10, -1, 9, "Muon_mediumId", "step1", "full"),
+    ("h_muhlt_tightid", "Muon tight idenitifcation; tight id; Events", 10, -1, 9, "Muon_tightId", "step1", "full"),
+    ("h_muhlt_pfisoid", "Muon PF isolation idenitifcation; pf iso id; Events", 10, -1, 9, "Muon_pfIsoId", "step1", "full"),
+    ("h_muhlt_puppiisoid", "Muon PUPPI isolation idenitifcation; puppi iso id; Events", 10, -1, 9, "Muon_puppiIsoId", "step1", "full"),
+    ("h_muhlt_relpfiso03", "Muon relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "Muon_pfRelIso03_all", "step1", "full"),
+    ("h_ehlt_n", "Electron N; N; Events", 20, 0, 20, "nElectron", "step1", "full"),
+    ("h_ehlt_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "Electron_pt", "step1", "full"),
+    ("h_ehlt_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "Electron_eta", "step1", "full"),
+    ("h_ehlt_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "Electron_phi", "step1", "full"),
+    ("h_ehlt_dxy", "Electron d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "Electron_dxy", "step1", "full"),
+    ("h_ehlt_dz", "Electron d_{z}; d_{z}; Events", 300, -1.5, 1.5, "Electron_dz", "step1", "full"),
+    ("h_ehlt_charge", "Electron charge; charge; Events", 10, -5, 5, "Electron_charge", "step1", "full"),
+    ("h_ehlt_mvabdtscore", "Electron MVA BDT Score; Score; Events", 110, -1.1, 1.1, "Electron_mvaFall17V2noIso", "step1", "full"),
+    ("h_ehlt_ismvabdtloose", "Electron MVA BDT WP Loose; is Loose; Events", 10, -5, 5, "Electron_mvaFall17V2noIso_WPL", "step1", "full"),
+    ("h_ehlt_relpfiso03", "Electron relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "Electron_pfRelIso03_all", "step1", "full"),
+    ("hprefilt_mutight_n", "Muon N; N; Events", 20, 0, 20, "MuTight_n", "step1", "validation"),
+    ("hprefilt_eltight_n", "Electron N; N; Events", 20, 0, 20, "ElTight_n", "step1", "validation"),
+    ("hpostfilt_mutight_n", "Muon N; N; Events", 20, 0, 20, "MuTight_n", "step2", "validation"),
+    ("h_mutight_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "MuTight_pt", "step1", "validation"),
+    ("h_mutight_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "MuTight_eta", "step1", "validation"),
+    ("h_mutight_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "MuTight_phi", "step1", "validation"),
+    ("h_mutight_dxy", "Muon d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "MuTight_dxy", "step1", "full"),
+    ("h_mutight_dz", "Muon d_{z}; d_{z}; Events", 300, -1.5, 1.5, "MuTight_dz", "step1", "full"),
+    ("h_mutight_charge", "Muon charge; charge; Events", 10, -5, 5, "MuTight_charge", "step1", "full"),
+    ("h_mutight_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "MuTight_fsrPhotonIdx", "step1", "full"),
+    ("h_mutight_cleanmask", "Muon clean mask; clean mask; Events", 10, -1, 9, "MuTight_cleanmask", "step1", "full"),
+    ("h_mutight_isglobal", "Muon is Global; is global; Events", 10, -1, 9, "MuTight_isGlobal", "step1", "full"),
+    ("h_mutight_isstandalone", "Muon is Standalone; is standalone; Events", 10, -1, 9, "MuTight_isStandalone", "step1", "full"),
+    ("h_mutight_istracker", "Muon is Tracker; is tracker; Events", 10, -1, 9, "MuTight_isTracker", "step1", "full"),
+    ("h_mutight_ntrackerlayers", "Muon hit count in tracker layers; number of tracker layers; Events", 23, -1, 22, "MuTight_nTrackerLayers", "step1", "full"),
+    ("h_mutight_highptid", "Muon cut based high pT identification; high pt id; Events", 10, -1, 9, "MuTight_highPtId", "step1", "full"),
+    ("h_mutight_looseid", "Muon loose idenitifcation; tight id; Events", 10, -1, 9, "MuTight_looseId", "step1", "full"),
+    ("h_mutight_mediumid", "Muon medium idenitifcation; tight id; Events", 10, -1, 9, "MuTight_mediumId", "step1", "full"),
+    ("h_mutight_tightid", "Muon tight idenitifcation; tight id; Events", 10, -1, 9, "MuTight_tightId", "step1", "full"),
+    ("h_mutight_pfisoid", "Muon PF isolation idenitifcation; pf iso id; Events", 10, -1, 9, "MuTight_pfIsoId", "step1", "full"),
+    ("h_mutight_puppiisoid", "Muon PUPPI isolation idenitifcation; puppi iso id; Events", 10, -1, 9, "MuTight_puppiIsoId", "step1", "full"),
+    ("h_mutight_relpfiso03", "Muon relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "MuTight_pfRelIso03_all", "step1", "full"),
+    ("hpostfilt_eltight_n", "Electron N; N; Events", 20, 0, 20, "ElTight_n", "step2", "validation"),
+    ("h_eltight_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "ElTight_pt", "step1", "validation"),
+    ("h_eltight_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "ElTight_eta", "step1", "validation"),
+    ("h_eltight_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "ElTight_phi", "step1", "validation"),
+    ("h_eltight_dxy", "Electron d_{xy}; d_{xy}; Events", 150, -0.75, 0.75, "ElTight_dxy", "step1", "full"),
+    ("h_eltight_dz", "Electron d_{z}; d_{z}; Events", 300, -1.5, 1.5, "ElTight_dz", "step1", "full"),
+    ("h_eltight_charge", "Electron charge; charge; Events", 10, -5, 5, "ElTight_charge", "step1", "full"),
+    ("h_eltight_mvabdtscore", "Electron MVA BDT Score; Score; Events", 110, -1.1, 1.1, "ElTight_mvaFall17V2noIso", "step1", "full"),
+    ("h_eltight_ismvabdtloose", "Electron MVA BDT WP Loose; is Loose; Events", 10, -5, 5, "ElTight_mvaFall17V2noIso_WPL", "step1", "full"),
+    ("h_eltight_relpfiso03", "Electron relative PF isolation all dR < 0.3; rel PF iso. dR < 0.3; Events", 100, 0, 1, "ElTight_pfRelIso03_all", "step1", "full"),
+    ("hprefilt_n_ZToMuMu", "Z #rightarrow #mu #mu N; N; Events", 15, -1, 14, "n_ZToMuMu", "step2", "validation"),
+    ("hprefilt_n_ZToElEl", "Z #rightarrow e e; N; Events", 15, -1, 14, "n_ZToElEl", "step2", "validation"),
+    ("hpostfilt_n_ZToMuMu", "Z #rightarrow #mu #mu N; N; Events", 15, -1, 14, "n_ZToMuMu", "step3", "validation"),
+    ("h_mass_ZToMuMu", "M; M (GeV/c); Events", 160, -10, 150, "M_ZToMuMu", "step3", "minimal"),
+    ("hpostfilt_n_ZToElEl", "Z #rightarrow e e; N; Events", 15, -1, 14, "n_ZToElEl", "step3", "validation"),
+    ("h_mass_ZToElEl", "M; M (GeV/c); Events", 160, -10, 150, "M_ZToElEl", "step3", "minimal"),
+    ("h_allZmumu_n", "Muon N; N; Events", 20, 0, 20, "MuTight_n", "step3", "validation"),
+    ("h_allZmumu_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "MuTight_pt", "step3", "validation"),
+    ("h_allZmumu_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "MuTight_eta", "step3", "validation"),
+    ("h_allZmumu_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "MuTight_phi", "step3", "validation"),
+    ("h_allZmumu_charge", "Muon charge; charge; Events", 10, -5, 5, "MuTight_charge", "step3", "full"),
+    ("h_allZmumu_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "MuTight_fsrPhotonIdx", "step3", "full"),
+    ("h_allZelel_n", "Electron N; N; Events", 20, 0, 20, "ElTight_n", "step3", "validation"),
+    ("h_allZelel_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "ElTight_pt", "step3", "validation"),
+    ("h_allZelel_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "ElTight_eta", "step3", "validation"),
+    ("h_allZelel_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "ElTight_phi", "step3", "validation"),
+    ("h_allZelel_charge", "Electron charge; charge; Events", 10, -5, 5, "ElTight_charge", "step3", "full"),
+    ("h_allZZ2Mu2ElIdxs_n", "ZZCand N; N; Events", 10, 0, 10, "ZZ2Mu2ElIdxs_n", "step3", "validation"),
+    ("h_zmupidx", "Muon Index; Index; Events", 20, 0, 20, "zmupidx", "step4", "full"),
+    ("h_zmup_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "zmup_pt", "step4", "validation"),
+    ("h_zmup_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "zmup_eta", "step4", "validation"),
+    ("h_zmup_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "zmup_phi", "step4", "validation"),
+    ("h_zmup_charge", "Muon charge; charge; Events", 10, -5, 5, "zmup_charge", "step4", "full"),
+    ("h_zmup_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "zmup_fsrPhotonIdx", "step4", "full"),
+    ("h_zmunidx", "Muon Index; Index; Events", 20, 0, 20, "zmunidx", "step4", "full"),
+    ("h_zmun_pt", "Muon p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "zmun_pt", "step4", "validation"),
+    ("h_zmun_eta", "Muon #eta; #eta; Events", 52, -2.6, 2.6, "zmun_eta", "step4", "validation"),
+    ("h_zmun_phi", "Muon #phi; #phi; Events", 68, -3.4, 3.4, "zmun_phi", "step4", "validation"),
+    ("h_zmun_charge", "Muon charge; charge; Events", 10, -5, 5, "zmun_charge", "step4", "full"),
+    ("h_zmun_fsrPhotonIdx", "Muon #gamma_idx; #gamma_idx; Events", 10, -1, 9, "zmun_fsrPhotonIdx", "step4", "full"),
+    ("h_zmu_mass", "M; M (GeV/c); Events", 160, -10, 150, "zmu_mass", "step4", "minimal"),
+    ("h_zelpidx", "Electron Index; Index; Events", 20, 0, 20, "zelpidx", "step4", "full"),
+    ("h_zelp_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "zelp_pt", "step4", "validation"),
+    ("h_zelp_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "zelp_eta", "step4", "validation"),
+    ("h_zelp_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "zelp_phi", "step4", "validation"),
+    ("h_zelp_charge", "Electron charge; charge; Events", 10, -5, 5, "zelp_charge", "step4", "full"),
+    ("h_zelnidx", "Electron Index; Index; Events", 20, 0, 20, "zelnidx", "step4", "full"),
+    ("h_zeln_pt", "Electron p_{T}; p_{T} (GeV/c); Events", 250, 0, 250, "zeln_pt", "step4", "validation"),
+    ("h_zeln_eta", "Electron #eta; #eta; Events", 52, -2.6, 2.6, "zeln_eta", "step4", "validation"),
+    ("h_zeln_phi", "Electron #phi; #phi; Events", 68, -3.4, 3.4, "zeln_phi", "step4", "validation"),
+    ("h_zeln_charge", "Electron charge; charge; Events", 10, -5, 5, "zeln_charge", "step4", "full"),
+    ("h_zel_mass", "M; M (GeV/c); Events", 160, -10, 150, "zel_mass", "step4", "minimal"),
+    ("h_ZZ_M", "ZZ M; M (GeV/c); Events", 250, 0, 500, "fourlep_mass", "higgs", "minimal"),
+]
+
+
+class BankedHistogram:
+
+    # One histogram of a HistoBank action, read and written like a Histo1D result
+    def __init__(self, bank, idx: int):
+        self.bank = bank
+        self.idx = idx
+
+    def GetValue(self):
+        return self.bank.GetValue()[self.idx]
+
+    def Write(self):
+        return self.GetValue().Write()
+
+
+def book_histo_bank(node, histo_rows: list):
+
+    # One action per node, every column is read once per event for all the histograms filled from it
+    columns = list(dict.fromkeys(row[5] for row in histo_rows))
+    specs = ROOT.std.vector["HistoSpec"]()
+    for name, title, nbins, xlow, xhigh, column, stage, profile in histo_rows:
+        specs.push_back(ROOT.HistoSpec(name, title, nbins, float(xlow), float(xhigh), columns.index(column)))
+
+    node = utils.raw_node(node)
+    column_types = tuple(node.GetColumnType(column) for column in columns)
+    return ROOT.BookHistoBank[column_types](ROOT.RDF.AsRNode(node), ROOT.std.vector["std::string"](columns), specs)
+
+
+def book_histograms(histo_table: list, nodes: dict, histo_profile: str = "full") -> list:
+
+    if histo_profile not in HISTO_PROFILES:
+        raise ValueError(f"Unknown histogram profile {histo_profile}, expected one of {HISTO_PROFILES}")
+    max_level = HISTO_PROFILES.index(histo_profile)
+    histo_rows = [row for row in histo_table if HISTO_PROFILES.index(row[7]) <= max_level]
+
+    # The distributed backends only run the built-in actions, so every histogram is its own Histo1D there
+    if any(utils.is_distributed(node) for node in nodes.values()):
+        return [nodes[stage].Histo1D((name, title, nbins, xlow, xhigh), column)
+                for name, title, nbins, xlow, xhigh, column, stage, profile in histo_rows]
+
+    # One bank per stage, the histograms keep the order of the table
+    banks = {}
+    for stage in dict.fromkeys(row[6] for row in histo_rows):
+        banks[stage] = book_histo_bank(nodes[stage], [row for row in histo_rows if row[6] == stage])
+
+    histograms = []
+    bank_idxs = dict.fromkeys(banks, 0)
+    for row in histo_rows:
+        histograms.append(BankedHistogram(banks[row[6]], bank_idxs[row[6]]))
+        bank_idxs[row[6]] += 1
+
+    return histograms
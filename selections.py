@@ -0,0 +1,211 @@
+import os
+import time
+import warnings
+
+import ROOT
+
+import utils
+
+
+# Trigger paths per channel. The 2mu2e channel uses the muon paths together
+# with the di-electron and muon-electron cross triggers.
+#   HLT_Mu8_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL -- problematic
+#   HLT_Mu23_TrkIsoVVL_Ele8_CaloIdL_TrackIdL_IsoVL -- problematic
+MUON_HLT_PATHS = ["HLT_Mu17_TrkIsoVVL_Mu8_TrkIsoVVL",
+                  "HLT_Mu17_TrkIsoVVL_TkMu8_TrkIsoVVL",
+                  "HLT_TripleMu_12_10_5",
+                  "HLT_IsoMu20", "HLT_IsoMu22", "HLT_IsoMu24",
+                  "HLT_IsoTkMu20", "HLT_IsoTkMu22", "HLT_IsoTkMu24"]
+
+ELECTRON_HLT_PATHS = ["HLT_Ele17_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
+                      "HLT_Ele23_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
+                      "HLT_Ele25_eta2p1_WPTight_Gsf",
+                      "HLT_Ele27_WPTight_Gsf",
+                      "HLT_Ele27_eta2p1_WPLoose_Gsf"]
+
+MUEL_HLT_PATHS = MUON_HLT_PATHS + ["HLT_Ele17_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
+                                   "HLT_Ele23_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
+                                   "HLT_Ele25_eta2p1_WPTight_Gsf",
+                                   "HLT_Ele27_eta2p1_WPLoose_Gsf",
+                                   "HLT_Mu8_TrkIsoVVL",
+                                   "HLT_Mu8_TrkIsoVVL_Ele17_CaloIdL_TrackIdL_IsoVL",
+                                   "HLT_Mu8_DiEle12_CaloIdL_TrackIdL",
+                                   "HLT_Mu17_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL",
+                                   "HLT_Mu23_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL",
+                                   "HLT_DiMu9_Ele9_CaloIdL_TrackIdL"]
+
+# Object selections for the good muons and electrons
+# muobject_selstr = "Muon_tightId == 1 && Muon_cleanmask == 1"
+MUOBJECT_SELSTR = "Muon_looseId == 1 && Muon_pt > 5 && abs(Muon_eta) < 2.4 && "\
+                  "abs(Muon_dxy) < 0.5 && abs(Muon_dz) < 1.0 && Muon_pfIsoId >= 2 && "\
+                  "(Muon_isTracker || Muon_isGlobal) && "\
+                  "Muon_pfRelIso03_all < 0.35"
+
+ELOBJECT_SELSTR = "Electron_pt > 7 && abs(Electron_eta) < 2.5 && Electron_mvaFall17V2noIso_WPL == 1 && " \
+                  "Electron_pfRelIso03_all < 0.35 && abs(Electron_dxy) < 0.5 && abs(Electron_dz) < 1"
+
+MUTIGHT_BRANCHES = ["pt", "eta", "phi", "dxy", "dz", "charge", "fsrPhotonIdx", "cleanmask",
+                    "isGlobal", "isStandalone", "isTracker", "nTrackerLayers", "highPtId",
+                    "looseId", "mediumId", "tightId", "pfIsoId", "puppiIsoId", "pfRelIso03_all"]
+
+ELTIGHT_BRANCHES = ["pt", "eta", "phi", "dxy", "dz", "charge", "mvaFall17V2noIso",
+                    "mvaFall17V2noIso_WPL", "pfRelIso03_all"]
+
+MU_MASS = 0.10565
+EL_MASS = 0.00051
+
+# Events read when profiling the preselection predicates
+PROFILE_SAMPLE_EVENTS = 50000
+
+# Certification files loaded in this process, in load order
+LOADED_LUMI_JSON_PATHS = []
+
+
+def hlt_selstr(hlt_paths: list) -> str:
+    return " || ".join(f"{hlt_path} == 1" for hlt_path in hlt_paths)
+
+
+def merge_hlt_paths(*hlt_path_lists) -> list:
+    # Union of the trigger paths, keeping the order of first appearance
+    merged = []
+    for hlt_paths in hlt_path_lists:
+        for hlt_path in hlt_paths:
+            if hlt_path not in merged:
+                merged.append(hlt_path)
+    return merged
+
+
+def load_lumi_mask(lumi_json_path: str, required: bool = False) -> int:
+
+    # Returns the index of the natively parsed mask for is_valid_in, -1 accepts every lumi section
+    if not os.path.exists(lumi_json_path):
+        if required:
+            raise FileNotFoundError(f"Lumi file {lumi_json_path} not found")
+        warnings.warn("Lumi file not found! Proceeding with analysis.")
+        return -1
+
+    # The load order fixes the mask indices, distributed workers replay it to get the same ones.
+    # The paths are made absolute so workers started in another directory find the files
+    lumi_json_path = os.path.abspath(lumi_json_path)
+    if lumi_json_path not in LOADED_LUMI_JSON_PATHS:
+        LOADED_LUMI_JSON_PATHS.append(lumi_json_path)
+    return ROOT.load_lumi_mask(lumi_json_path)
+
+
+def lumi_mask_selstr(lumimask_idx: int):
+    if lumimask_idx < 0:
+        return None
+    return f"is_valid_in({lumimask_idx}, run, luminosityBlock)"
+
+
+def preselection_predicates(hlt_paths: list, lumi_selstr: str = None) -> list:
+
+    # ==================================
+    # Step 1 - HLT Filter and Atleast 1 good primary vertex
+    # ==================================
+    predicates = []
+    if lumi_selstr is not None:
+        predicates.append(("Lumi mask", lumi_selstr))
+    predicates.append(("Step 1 - HLT", hlt_selstr(hlt_paths)))
+    predicates.append(("Step 1 - Good primary vertex", "PV_npvsGood >= 1"))
+
+    return predicates
+
+
+def order_hlt_paths(hlt_paths: list, profile: dict = None) -> list:
+    # Most frequently fired paths first, so the OR short-circuits early
+    if profile is None:
+        return hlt_paths
+    return sorted(hlt_paths, key=lambda hlt_path: -profile["hlt_rates"].get(hlt_path, 0.0))
+
+
+def profile_preselection(input_file, hlt_paths: list, lumi_selstr: str = None,
+                         n_sample: int = PROFILE_SAMPLE_EVENTS) -> dict:
+
+    # Range needs a sequential event loop, implicit MT is restored afterwards
+    n_threads = ROOT.GetThreadPoolSize() if ROOT.IsImplicitMTEnabled() else 0
+    if n_threads > 0:
+        ROOT.DisableImplicitMT()
+
+    try:
+        df = ROOT.RDataFrame("Events", input_file).Range(n_sample)
+
+        # Firing rate of every trigger path, all counted in one event loop
+        n_events = df.Count()
+        n_fired = {hlt_path: df.Filter(f"{hlt_path} == 1").Count() for hlt_path in hlt_paths}
+        n_events = max(n_events.GetValue(), 1)
+        hlt_rates = {hlt_path: count.GetValue() / n_events for hlt_path, count in n_fired.items()}
+
+        predicates = preselection_predicates(order_hlt_paths(hlt_paths, {"hlt_rates": hlt_rates}), lumi_selstr)
+        n_pass = {name: df.Filter(selstr).Count() for name, selstr in predicates}
+        rejections = {name: 1.0 - count.GetValue() / n_events for name, count in n_pass.items()}
+
+        # Each predicate alone in its own loop, the bare loop time is subtracted
+        start_time = time.time()
+        df.Count().GetValue()
+        loop_time = time.time() - start_time
+        costs = {}
+        for name, selstr in predicates:
+            count = df.Filter(selstr).Count()
+            start_time = time.time()
+            count.GetValue()
+            costs[name] = max(time.time() - start_time - loop_time, 0.0) / n_events
+    finally:
+        if n_threads > 0:
+            ROOT.EnableImplicitMT(n_threads)
+
+    # Cheapest and most rejecting predicates first
+    order = sorted(costs, key=lambda name: costs[name] / max(rejections[name], 1e-6))
+    for name in order:
+        print(f"Profiled '{name}': rejection {rejections[name]:.3f}, cost {costs[name] * 1e9:.0f} ns/event")
+
+    return {"order": order, "hlt_rates": hlt_rates}
+
+
+def apply_preselection(df, hlt_paths: list, lumi_selstr: str = None, profile: dict = None):
+
+    # The preselection predicates commute, so a profiled order leaves every histogram unchanged
+    predicates = preselection_predicates(order_hlt_paths(hlt_paths, profile), lumi_selstr)
+    if profile is not None:
+        predicates.sort(key=lambda predicate: profile["order"].index(predicate[0]))
+
+    df = utils.set_stage(df, "Step 1 - Preselection")
+    for name, selstr in predicates:
+        df = df.Filter(selstr, name)
+
+    return df
+
+
+def define_slim_collection(df, collection: str, slim_name: str, selstr: str, branches: list):
+
+    # The selection is evaluated once into {slim_name}_mask and applied to every branch,
+    # e.g. define_slim_collection(df, "Muon", "MuTight", MUOBJECT_SELSTR, MUTIGHT_BRANCHES)
+    df = utils.set_stage(df, "Step 2 - Object selection")
+    df = df.Define(f"{slim_name}_mask", selstr)
+    for branch in branches:
+        df = df.Define(f"{slim_name}_{branch}", f"{collection}_{branch}[{slim_name}_mask]")
+    df = df.Define(f"{slim_name}_n", f"{slim_name}_{branches[0]}.size()")
+
+    return df
+
+
+def define_tight_muons(df):
+
+    df = define_slim_collection(df, "Muon", "MuTight", MUOBJECT_SELSTR, MUTIGHT_BRANCHES)
+    # FSR-dressed four-vectors and DeltaR table read by the Z, ZZ and Higgs kernels
+    df = df.Define("MuTight_dressed", "DressLeptons(MuTight_pt, MuTight_eta, MuTight_phi, MuTight_charge, "
+                                      f"MuTight_fsrPhotonIdx, {MU_MASS}, FsrPhoton_pt, FsrPhoton_eta, FsrPhoton_phi)")
+    # Pair masses and dressed sums shared by the Z counting, the ZZ choice and the Higgs cuts
+    df = df.Define("MuTight_pairs", "PairLeptons(MuTight_dressed)")
+
+    return df
+
+
+def define_tight_electrons(df):
+
+    df = define_slim_collection(df, "Electron", "ElTight", ELOBJECT_SELSTR, ELTIGHT_BRANCHES)
+    # Electrons are not associated to FSR photons
+    df = df.Define("ElTight_dressed", f"DressLeptons(ElTight_pt, ElTight_eta, ElTight_phi, ElTight_charge, {EL_MASS})")
+    df = df.Define("ElTight_pairs", "PairLeptons(ElTight_dressed)")
+
+    return df
@@ -0,0 +1,191 @@
+import concurrent.futures
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import warnings
+
+import ROOT
+
+import cpp_utils
+import file_stager
+import utils
+
+
+# Sharded runs analyse every group of input files on its own, into partial outputs in
+# <output stem>_shards/. A shard is recorded in the manifest there once all its partial
+# outputs, including the snapshot and pick events, are written, so a rerun only analyses
+# the shards that are missing or failed.
+# Shards are named by the identity of their files, so a rerun also picks up files added to
+# or replaced in the dataset and drops the shards of removed files. With one file per shard
+# an added file leaves every other shard unchanged
+FILES_PER_SHARD = 1
+SHARD_MANIFEST = "manifest.json"
+
+
+def shard_id(identities: list) -> str:
+    return hashlib.sha256(json.dumps(identities, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def make_shards(input_glob: str, files_per_shard: int = FILES_PER_SHARD) -> dict:
+    input_files = file_stager.list_input_files(input_glob)
+    if not input_files:
+        raise RuntimeError(f"No input files match {input_glob}")
+    identities = [file_stager.file_identity(url) for url in input_files]
+    shards = [identities[idx:idx + files_per_shard] for idx in range(0, len(identities), files_per_shard)]
+    return {shard_id(shard_identities): shard_identities for shard_identities in shards}
+
+
+def shard_output_paths(shard_outputs: dict, pick_events: bool = False) -> list:
+
+    # Every file a shard writes: the histograms, the Parquet snapshot and the pick events when requested
+    paths = []
+    for output_file, save_snapshot_path in shard_outputs.values():
+        paths.append(output_file)
+        if save_snapshot_path is not None:
+            paths.append(f"{save_snapshot_path}.parquet")
+        if pick_events:
+            paths.append(utils.pick_events_path(output_file))
+    return paths
+
+
+def drop_stale_shards(manifest: dict, shards: dict) -> list:
+
+    # Shards of removed or replaced files, their partial outputs are deleted
+    stale = [sid for sid in manifest["shards"] if sid not in shards]
+    for sid in stale:
+        shard_outputs = manifest["shards"][sid]["outputs"]
+        paths = shard_output_paths(shard_outputs, pick_events=True)
+        paths += [f"{save_snapshot_path}.json" for _, save_snapshot_path in shard_outputs.values()
+                  if save_snapshot_path is not None]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        del manifest["shards"][sid]
+    return stale
+
+
+def shard_dir_for(channel_outputs: dict) -> str:
+    # Next to the output of the first channel, e.g. 4mu_output.root -> 4mu_output_shards/
+    first_output = next(iter(channel_outputs.values()))[0]
+    return f"{os.path.splitext(first_output)[0]}_shards"
+
+
+def shard_outputs_for(channel_outputs: dict, shard_dir: str, sid: str) -> dict:
+    shard_outputs = {}
+    for channel, (output_file, save_snapshot_path) in channel_outputs.items():
+        stem = os.path.splitext(os.path.basename(output_file))[0]
+        shard_snapshot = None
+        if save_snapshot_path is not None:
+            shard_snapshot = os.path.join(shard_dir, f"{os.path.basename(save_snapshot_path)}_{sid}")
+        shard_outputs[channel] = (os.path.join(shard_dir, f"{stem}_{sid}.root"), shard_snapshot)
+    return shard_outputs
+
+
+def read_manifest(shard_dir: str) -> dict:
+    manifest_path = os.path.join(shard_dir, SHARD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {"shards": {}}
+    with open(manifest_path) as manifest_f:
+        return json.load(manifest_f)
+
+
+def write_manifest(shard_dir: str, manifest: dict):
+    # Replaced in one step, so an interrupted run never leaves a truncated manifest
+    manifest_path = os.path.join(shard_dir, SHARD_MANIFEST)
+    with open(f"{manifest_path}.tmp", "w") as manifest_f:
+        json.dump(manifest, manifest_f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def shard_done(manifest: dict, sid: str, pick_events: bool = False) -> bool:
+    # Done only while every output of the shard exists, including the ones this run requests
+    if sid not in manifest["shards"]:
+        return False
+    return all(os.path.exists(path) for path in shard_output_paths(manifest["shards"][sid]["outputs"], pick_events))
+
+
+def init_shard_worker(n_threads: int):
+    if n_threads > 1:
+        ROOT.EnableImplicitMT(n_threads)
+    cpp_utils.cpp_utils()
+
+
+def run_shard(module_name: str, func_name: str, shard_identities: list, shard_outputs: dict, lumi_json_path: str,
+              fused: bool, kwargs: dict):
+
+    # Runs in a worker process. The analysers are looked up by name, their modules start with a digit
+    analyse = getattr(importlib.import_module(module_name), func_name)
+    shard_files = [identity["path"] for identity in shard_identities]
+    shard_input = shard_files[0] if len(shard_files) == 1 else shard_files
+    if fused:
+        analyse(shard_input, shard_outputs, lumi_json_path, **kwargs)
+    else:
+        output_file, save_snapshot_path = next(iter(shard_outputs.values()))
+        analyse(shard_input, output_file, lumi_json_path, save_snapshot_path, **kwargs)
+
+
+@utils.time_eval
+def run_shards(module_name: str, func_name: str, input_glob: str, channel_outputs: dict, lumi_json_path: str = "",
+               fused: bool = False, files_per_shard: int = FILES_PER_SHARD, n_workers: int = 1, **kwargs):
+
+    shard_dir = shard_dir_for(channel_outputs)
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest = read_manifest(shard_dir)
+    shards = make_shards(input_glob, files_per_shard)
+
+    stale = drop_stale_shards(manifest, shards)
+    write_manifest(shard_dir, manifest)
+    pick_events = kwargs.get("pick_events", False)
+    todo = [sid for sid in shards if not shard_done(manifest, sid, pick_events)]
+    print(f"Sharded run of {input_glob}: {len(shards)} shards, {len(shards) - len(todo)} already done, "
+          f"{len(stale)} dropped for removed or changed files")
+
+    # Every worker gets its share of the cores for implicit MT. The workers are spawned,
+    # so they start without the ROOT state of this process
+    n_threads = max((os.cpu_count() or 1) // n_workers, 1)
+    failed = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=init_shard_worker, initargs=(n_threads,)) as executor:
+        futures = {}
+        for sid in todo:
+            shard_outputs = shard_outputs_for(channel_outputs, shard_dir, sid)
+            futures[executor.submit(run_shard, module_name, func_name, shards[sid], shard_outputs,
+                                    lumi_json_path, fused, kwargs)] = (sid, shard_outputs)
+
+        for future in concurrent.futures.as_completed(futures):
+            sid, shard_outputs = futures[future]
+            try:
+                future.result()
+                missing = [path for path in shard_output_paths(shard_outputs, pick_events) if not os.path.exists(path)]
+                if missing:
+                    raise RuntimeError(f"outputs not written: {', '.join(missing)}")
+            except Exception as e:
+                failed[sid] = e
+                warnings.warn(f"Shard {sid} ({', '.join(identity['path'] for identity in shards[sid])}) failed: {e}")
+                continue
+            manifest["shards"][sid] = {"files": shards[sid], "outputs": shard_outputs}
+            write_manifest(shard_dir, manifest)
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(shards)} shards failed, rerun to retry them: {', '.join(failed)}")
+
+    # The partial outputs are kept, so a rerun after new files are added only analyses those
+    for channel, (output_file, save_snapshot_path) in channel_outputs.items():
+        file_stager.merge_histogram_files([manifest["shards"][sid]["outputs"][channel][0] for sid in shards],
+                                          output_file, remove_parts=False)
+        if kwargs.get("pick_events"):
+            file_stager.merge_histogram_files([utils.pick_events_path(manifest["shards"][sid]["outputs"][channel][0])
+                                               for sid in shards], utils.pick_events_path(output_file), remove_parts=False)
+        if save_snapshot_path is not None:
+            utils.merge_event_snapshots([manifest["shards"][sid]["outputs"][channel][1] for sid in shards],
+                                        save_snapshot_path, remove_parts=False)
+
+
+def analyse_sharded(module_name: str, func_name: str, input_glob: str, output_file: str, lumi_json_path: str = "",
+                    save_snapshot_path=None, files_per_shard: int = FILES_PER_SHARD, n_workers: int = 1, **kwargs):
+    # e.g. analyse_sharded("4mu_analyser", "analyse_4mu_data", input_glob, "4mu_output.root", cert, "4mu_snapshot")
+    run_shards(module_name, func_name, input_glob, {"": (output_file, save_snapshot_path)}, lumi_json_path,
+               False, files_per_shard, n_workers, **kwargs)
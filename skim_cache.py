@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import warnings
+
+import ROOT
+from ROOT import RDataFrame
+
+import file_stager
+import histogram_tables
+import selections
+import utils
+
+
+# Local skims of the NanoAOD inputs, holding only the preselected events and the columns read
+# by the analysers. Every skim is named by a hash of its inputs, so changing the branch list,
+# the trigger paths, the certification file or the files matched by the input builds a new one
+# instead of reusing a stale one
+SKIM_CACHE_DIR = os.environ.get("HTO4L_SKIM_CACHE_DIR",
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), ".skim_cache"))
+
+# Bumped whenever the skim content changes in a way not covered by the hash inputs
+SKIM_VERSION = 1
+
+# LZ4 decompresses several times faster than the ZLIB default of the NanoAOD files
+SKIM_COMPRESSION_ALGORITHM = "kLZ4"
+SKIM_COMPRESSION_LEVEL = 4
+
+# Event and preselection columns, on top of the object and histogram columns
+SKIM_EVENT_COLUMNS = ["run", "luminosityBlock", "event", "PV_npvsGood"]
+SKIM_FSR_COLUMNS = ["nFsrPhoton", "FsrPhoton_pt", "FsrPhoton_eta", "FsrPhoton_phi"]
+
+
+def skim_columns(hlt_paths: list) -> list:
+
+    # Raw NanoAOD columns of the object selections and of the step 1 histograms
+    columns = SKIM_EVENT_COLUMNS + hlt_paths + SKIM_FSR_COLUMNS
+    columns += ["nMuon"] + [f"Muon_{branch}" for branch in selections.MUTIGHT_BRANCHES]
+    columns += ["nElectron"] + [f"Electron_{branch}" for branch in selections.ELTIGHT_BRANCHES]
+    for histo_table in [histogram_tables.HISTOS_4MU, histogram_tables.HISTOS_4E, histogram_tables.HISTOS_2MU2E]:
+        columns += [row[5] for row in histo_table if row[6] == "step1" and not row[5].startswith(("MuTight_", "ElTight_"))]
+
+    return list(dict.fromkeys(columns))
+
+
+def file_hash(path: str) -> str:
+    if not os.path.exists(path):
+        return ""
+    with open(path, "rb") as path_f:
+        return hashlib.sha256(path_f.read()).hexdigest()
+
+
+def input_identities(input_file) -> list:
+
+    # The matched files with their size and modification time, so added, replaced or removed files change the key
+    input_globs = [input_file] if isinstance(input_file, str) else list(input_file)
+    input_files = sorted(url for input_glob in input_globs for url in file_stager.list_input_files(input_glob))
+    if not input_files:
+        raise RuntimeError(f"No input files match {input_file}")
+    return [file_stager.file_identity(url) for url in input_files]
+
+
+def skim_cache_key(input_file, hlt_paths: list, lumi_json_path: str = "") -> str:
+    key = {"version": SKIM_VERSION, "input": input_identities(input_file), "columns": skim_columns(hlt_paths),
+           "hlt_paths": hlt_paths, "cert": file_hash(lumi_json_path),
+           "compression": [SKIM_COMPRESSION_ALGORITHM, SKIM_COMPRESSION_LEVEL]}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def skim_cache_path(input_file, hlt_paths: list, lumi_json_path: str = "",
+                    cache_dir: str = SKIM_CACHE_DIR) -> str:
+    return os.path.join(cache_dir, f"skim_{skim_cache_key(input_file, hlt_paths, lumi_json_path)}.root")
+
+
+@utils.time_eval
+def build_skim(input_file: str, skim_path: str, hlt_paths: list, lumi_json_path: str = ""):
+
+    # The same lumi, HLT and primary vertex preselection as the analysers, which apply it again
+    # on the skim at negligible cost
+    lumi_selstr = selections.lumi_mask_selstr(selections.load_lumi_mask(lumi_json_path))
+    df = RDataFrame("Events", input_file)
+    print(f"Skimming path: {input_file} into {skim_path}")
+
+    available = set(str(column) for column in df.GetColumnNames())
+    columns = skim_columns(hlt_paths)
+    missing = [column for column in columns if column not in available]
+    if missing:
+        warnings.warn(f"Columns missing from {input_file} are not skimmed: {', '.join(missing)}")
+    columns = [column for column in columns if column in available]
+
+    df = selections.apply_preselection(df, hlt_paths, lumi_selstr)
+
+    options = ROOT.RDF.RSnapshotOptions()
+    options.fCompressionAlgorithm = getattr(ROOT.RCompressionSetting.EAlgorithm, SKIM_COMPRESSION_ALGORITHM)
+    options.fCompressionLevel = SKIM_COMPRESSION_LEVEL
+
+    # Written under a temporary name, so an interrupted skim is never picked up as a cache hit
+    tmp_path = f"{skim_path}.{os.getpid()}.tmp"
+    df.Snapshot("Events", tmp_path, columns, options)
+    os.replace(tmp_path, skim_path)
+
+
+def cached_input(input_file: str, hlt_paths: list, lumi_json_path: str = "", cache_dir: str = SKIM_CACHE_DIR) -> str:
+
+    # Builds the skim on the first run, later runs with the same inputs read it directly
+    os.makedirs(cache_dir, exist_ok=True)
+    skim_path = skim_cache_path(input_file, hlt_paths, lumi_json_path, cache_dir)
+    if os.path.exists(skim_path):
+        print(f"Reading skim cache {skim_path} for path: {input_file}")
+    else:
+        build_skim(input_file, skim_path, hlt_paths, lumi_json_path)
+
+    return skim_path
@@ -0,0 +1,22 @@
+import os
+import pathlib
+import sys
+
+import pytest
+
+
+# The analysis scripts are run from their own directories, the tests import them from there
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [REPO_DIR, os.path.join(REPO_DIR, "combine_json"), os.path.join(REPO_DIR, "PostMix_IGFiles")]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def write_file():
+    # Writes a small stand-in for an input or output file, creating its directory
+    def write(path, content="0"):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return write
@@ -0,0 +1,54 @@
+import json
+
+import combine_json
+
+
+def candidate(run, lumi, event, mass):
+    return {"run": run, "luminosityBlock": lumi, "event": event, "fourlep_mass": mass}
+
+
+def write_candidates(path, candidates):
+    with open(path, "w") as json_f:
+        json.dump(candidates, json_f, indent=2)
+
+
+def test_iter_json_array_across_chunks(tmp_path):
+    candidates = [candidate(278820, 100 + i, 1000 + i, 125.0 + i) for i in range(20)]
+    write_candidates(tmp_path / "4mu_doublemu_2016G.json", candidates)
+
+    # Chunks much smaller than one object, every object spans several reads
+    for chunk_size in [1, 7, 64, combine_json.READ_CHUNK_SIZE]:
+        assert list(combine_json.iter_json_array(str(tmp_path / "4mu_doublemu_2016G.json"), chunk_size)) == candidates
+
+
+def test_iter_json_array_empty(tmp_path):
+    for content in ["[]", "[\n]", ""]:
+        (tmp_path / "empty.json").write_text(content)
+        assert list(combine_json.iter_json_array(str(tmp_path / "empty.json"), 4)) == []
+
+
+def test_combine_json_files(tmp_path):
+    write_candidates(tmp_path / "4mu_doublemu_2016G.json", [candidate(1, 1, 10, 125.0), candidate(1, 2, 11, 126.0)])
+    write_candidates(tmp_path / "4e_doublemu_2016G.json", [candidate(1, 1, 10, 124.0)])
+    # Same event number in another run is another event
+    write_candidates(tmp_path / "2mu2e_doublemu_2016G.json", [candidate(2, 1, 10, 123.0), candidate(1, 2, 11, 122.0)])
+
+    datasets = combine_json.group_candidate_files(str(tmp_path / "*.json"))
+    assert list(datasets) == ["doublemu_2016G"]
+    assert [oldfiledict["type"] for oldfiledict in datasets["doublemu_2016G"]] == ["4mu", "4e", "2mu2e"]
+
+    combine_json.combine_json_files("doublemu_2016G.json", datasets["doublemu_2016G"], str(tmp_path))
+    combined_text = (tmp_path / "doublemu_2016G.json").read_text()
+    combined = json.loads(combined_text)
+
+    # Duplicates are kept from the channel first in CHANNEL_PRIORITY
+    assert [(event["run"], event["event"], event["type"], event["fourlep_mass"]) for event in combined] == \
+        [(1, 10, "4mu", 125.0), (1, 11, "4mu", 126.0), (2, 10, "2mu2e", 123.0)]
+    assert combined_text == json.dumps(combined, indent=4)
+
+
+def test_combine_json_files_without_candidates(tmp_path):
+    write_candidates(tmp_path / "4mu_doublemu_2016G.json", [])
+    combine_json.combine_json_files("doublemu_2016G.json", [{"type": "4mu", "file": str(tmp_path / "4mu_doublemu_2016G.json")}],
+                                    str(tmp_path))
+    assert json.loads((tmp_path / "doublemu_2016G.json").read_text()) == []
@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip("ROOT")
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+import utils
+
+
+def write_part(path, n_candidates):
+    schema = utils.snapshot_schema(utils.SNAPSHOT_COLUMNS)
+    columns = {"run": [279766] * n_candidates, "luminosityBlock": [225] * n_candidates,
+               "event": list(range(n_candidates)), "fourlep_mass": [125.0] * n_candidates,
+               "fourlep_pts": [[40.0, 30.0, 20.0, 10.0]] * n_candidates,
+               "fourlep_etas": [[0.1, 0.2, 0.3, 0.4]] * n_candidates,
+               "fourlep_phis": [[1.0, 2.0, 3.0, -1.0]] * n_candidates,
+               "fourlep_pids": [[13, -13, 13, -13]] * n_candidates}
+    pq.write_table(pa.table(columns, schema=schema), f"{path}.parquet")
+
+
+def test_merge_skips_empty_part(tmp_path):
+    write_part(tmp_path / "part0", 0)
+    write_part(tmp_path / "part1", 3)
+
+    utils.merge_event_snapshots([str(tmp_path / "part0"), str(tmp_path / "part1")], str(tmp_path / "merged"),
+                                write_json=False)
+
+    merged = pq.read_table(tmp_path / "merged.parquet")
+    assert merged.num_rows == 3
+    assert merged.schema == utils.snapshot_schema(utils.SNAPSHOT_COLUMNS)
+
+
+def test_merge_of_empty_parts_is_typed(tmp_path):
+    write_part(tmp_path / "part0", 0)
+
+    utils.merge_event_snapshots([str(tmp_path / "part0")], str(tmp_path / "merged"), write_json=False)
+
+    merged = pq.read_table(tmp_path / "merged.parquet")
+    assert merged.num_rows == 0
+    assert merged.schema == utils.snapshot_schema(utils.SNAPSHOT_COLUMNS)
+
+
+class Result:
+
+    # Stands in for a lazy RDataFrame result whose event loop already ran
+    def __init__(self, value):
+        self.value = value
+
+    def GetValue(self):
+        return self.value
+
+
+def test_snapshot_without_candidates_is_typed(tmp_path):
+    # The lazy ROOT snapshot left no file, as it can when no event is selected
+    snapshot = utils.EventSnapshot(Result(None), Result(0))
+
+    utils.write_event_snapshot(snapshot, str(tmp_path / "part0"), utils.SNAPSHOT_COLUMNS)
+
+    part = pq.read_table(tmp_path / "part0.parquet")
+    assert part.num_rows == 0
+    assert part.schema == utils.snapshot_schema(utils.SNAPSHOT_COLUMNS)
+    assert (tmp_path / "part0.json").read_text() == "[]"
+
+
+def test_snapshot_failure_is_raised(tmp_path):
+    # Candidates were selected but the ROOT snapshot is missing
+    snapshot = utils.EventSnapshot(Result(None), Result(3))
+
+    with pytest.raises(FileNotFoundError):
+        utils.write_event_snapshot(snapshot, str(tmp_path / "part0"), utils.SNAPSHOT_COLUMNS)
+
+
+def test_merge_of_missing_part_raises(tmp_path):
+    write_part(tmp_path / "part0", 3)
+
+    with pytest.raises(FileNotFoundError):
+        utils.merge_event_snapshots([str(tmp_path / "part0"), str(tmp_path / "part1")], str(tmp_path / "merged"),
+                                    write_json=False)
@@ -0,0 +1,110 @@
+import os
+import subprocess
+
+import pytest
+
+pytest.importorskip("ROOT")
+
+import file_stager
+
+
+def write_file(path, n_bytes):
+    with open(path, "wb") as f:
+        f.write(b"0" * n_bytes)
+
+
+def source_file(tmp_path, name, n_bytes=1):
+    # Input file the staged copies are keyed on
+    sources = tmp_path / "sources"
+    sources.mkdir(exist_ok=True)
+    write_file(sources / name, n_bytes)
+    return str(sources / name)
+
+
+def pending_copy(stager, url, n_bytes):
+    # A copy still running, its partial file already holds n_bytes
+    tmp_path = f"{stager.staged_path(url)}.{os.getpid()}.tmp"
+    write_file(tmp_path, n_bytes)
+    stager.pending[url] = (subprocess.Popen(["sleep", "60"]), tmp_path)
+    return tmp_path
+
+
+def test_evict_counts_running_copies(tmp_path):
+    stager = file_stager.FileStager(str(tmp_path / "cache"), limit_gb=150 / 1024**3)
+    old_path = stager.staged_path(source_file(tmp_path, "old.root"))
+    new_path = stager.staged_path(source_file(tmp_path, "new.root"))
+    write_file(old_path, 100)
+    write_file(new_path, 20)
+    os.utime(old_path, (0, 0))
+    tmp_path_pending = pending_copy(stager, source_file(tmp_path, "next.root"), 100)
+
+    stager.evict()
+
+    assert not os.path.exists(old_path)
+    assert os.path.exists(new_path)
+    assert os.path.exists(tmp_path_pending)
+    stager.close()
+
+
+def test_evict_removes_orphaned_copies(tmp_path):
+    stager = file_stager.FileStager(str(tmp_path / "cache"))
+    orphan_path = f"{stager.staged_path(source_file(tmp_path, 'orphan.root'))}.{os.getpid()}.tmp"
+    write_file(orphan_path, 10)
+
+    stager.evict()
+
+    assert not os.path.exists(orphan_path)
+
+
+def test_close_stops_pending_copies(tmp_path):
+    next_url = source_file(tmp_path, "next.root")
+    with file_stager.FileStager(str(tmp_path / "cache")) as stager:
+        tmp_path_pending = pending_copy(stager, next_url, 10)
+        process = stager.pending[next_url][0]
+
+    assert process.returncode is not None
+    assert not os.path.exists(tmp_path_pending)
+    assert not stager.pending
+
+
+def test_analyse_staged_cleans_up_after_failure(tmp_path):
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    for idx in range(3):
+        write_file(inputs / f"file{idx}.root", 10)
+    stager = file_stager.FileStager(str(tmp_path / "cache"))
+
+    def failing_analyse(*args, **kwargs):
+        raise RuntimeError("analysis failed")
+
+    with pytest.raises(RuntimeError):
+        file_stager.analyse_staged(failing_analyse, str(inputs / "*.root"), str(tmp_path / "output.root"),
+                                   stager=stager)
+
+    assert not stager.pending
+    assert not [name for name in os.listdir(tmp_path / "cache") if name.endswith(".tmp")]
+
+
+def test_replaced_input_is_fetched_again(tmp_path):
+    url = source_file(tmp_path, "input.root", 10)
+    staged_path = file_stager.FileStager(str(tmp_path / "cache")).acquire(url)
+    assert os.path.getsize(staged_path) == 10
+    assert file_stager.FileStager(str(tmp_path / "cache")).acquire(url) == staged_path
+
+    write_file(url, 20)
+    replaced_path = file_stager.FileStager(str(tmp_path / "cache")).acquire(url)
+    assert replaced_path != staged_path
+    assert os.path.getsize(replaced_path) == 20
+
+
+def test_file_identity(tmp_path):
+    write_file(tmp_path / "a.root", 10)
+    identity = file_stager.file_identity(str(tmp_path / "a.root"))
+    assert identity["size"] == 10
+    assert file_stager.file_identity(f"file://{tmp_path}/a.root")["mtime"] == identity["mtime"]
+
+    stat_output = "Path:   /eos/opendata/a.root\nId:     1234\nSize:   2269418402\n" \
+                  "MTime:  2021-07-19 20:18:43\nFlags:  16 (IsReadable)\n"
+    assert file_stager.parse_xrootd_stat(stat_output) == {"size": 2269418402, "mtime": "2021-07-19 20:18:43"}
+    with pytest.raises(RuntimeError):
+        file_stager.parse_xrootd_stat("[ERROR] Server responded with an error")
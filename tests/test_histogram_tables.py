@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip("ROOT")
+
+import histogram_tables
+
+HISTO_TABLES = [histogram_tables.HISTOS_4MU, histogram_tables.HISTOS_4E, histogram_tables.HISTOS_2MU2E]
+HISTO_STAGES = ["step1", "step2", "step3", "step4", "higgs"]
+
+
+class FakeBank:
+
+    # Stands in for the HistoBank result, its value lists the names of the booked histograms
+    def __init__(self, histo_rows):
+        self.names = [row[0] for row in histo_rows]
+
+    def GetValue(self):
+        return self.names
+
+
+@pytest.fixture
+def fake_banks(monkeypatch):
+    booked = []
+
+    def book_histo_bank(node, histo_rows):
+        booked.append((node, [row[0] for row in histo_rows]))
+        return FakeBank(histo_rows)
+
+    monkeypatch.setattr(histogram_tables, "book_histo_bank", book_histo_bank)
+    return booked
+
+
+def test_histo_tables():
+    for histo_table in HISTO_TABLES:
+        assert len(set(row[0] for row in histo_table)) == len(histo_table)
+        for name, title, nbins, xlow, xhigh, column, stage, profile in histo_table:
+            assert stage in HISTO_STAGES and profile in histogram_tables.HISTO_PROFILES
+            assert nbins > 0 and xlow < xhigh
+
+
+@pytest.mark.parametrize("histo_profile", histogram_tables.HISTO_PROFILES)
+def test_book_histograms(fake_banks, histo_profile):
+    nodes = {stage: f"node_{stage}" for stage in HISTO_STAGES}
+    histograms = histogram_tables.book_histograms(histogram_tables.HISTOS_4MU, nodes, histo_profile)
+
+    # Every profile books its own histograms and those of the smaller profiles, in table order
+    max_level = histogram_tables.HISTO_PROFILES.index(histo_profile)
+    names = [row[0] for row in histogram_tables.HISTOS_4MU
+             if histogram_tables.HISTO_PROFILES.index(row[7]) <= max_level]
+    assert [histogram.GetValue() for histogram in histograms] == names
+
+    # One bank per stage, booked on the node of that stage
+    assert len(fake_banks) == len(set(node for node, _ in fake_banks))
+    for node, bank_names in fake_banks:
+        stage = node[len("node_"):]
+        assert bank_names == [row[0] for row in histogram_tables.HISTOS_4MU if row[6] == stage and row[0] in names]
+
+
+def test_book_histograms_unknown_profile(fake_banks):
+    with pytest.raises(ValueError):
+        histogram_tables.book_histograms(histogram_tables.HISTOS_4MU, {}, "everything")
@@ -0,0 +1,192 @@
+import json
+import os
+import zipfile
+
+import pytest
+
+pytest.importorskip("matplotlib")
+pytest.importorskip("yaml")
+
+import postmix_igfiles_forcands as postmix
+
+
+def ig_event(event):
+    return {'Types': {}, 'Collections': {}, 'event': event, 'pad': 'x' * 200}
+
+
+class UnseekableFile:
+
+    # zipfile writes data descriptors after the entries when the output cannot seek back
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+@pytest.fixture
+def source_igfile(tmp_path):
+    igfile = tmp_path / 'source.ig'
+    with zipfile.ZipFile(igfile, 'w') as z:
+        z.writestr('Header', '{}')
+        z.writestr('Events/Run_1/Event_1', json.dumps(ig_event(1)), compress_type=zipfile.ZIP_STORED)
+        z.writestr('Events/Run_1/Event_2', json.dumps(ig_event(2)), compress_type=zipfile.ZIP_DEFLATED)
+    return igfile
+
+
+@pytest.fixture
+def streamed_igfile(tmp_path):
+    igfile = tmp_path / 'streamed.ig'
+    with open(igfile, 'wb') as f:
+        with zipfile.ZipFile(UnseekableFile(f), 'w', compression=zipfile.ZIP_DEFLATED) as z:
+            z.writestr('Events/Run_1/Event_3', json.dumps(ig_event(3)))
+    return igfile
+
+
+def test_copy_ig_event(tmp_path, source_igfile, streamed_igfile):
+    with zipfile.ZipFile(tmp_path / 'out.ig', 'w', compression=zipfile.ZIP_DEFLATED) as zout:
+        with zipfile.ZipFile(source_igfile) as zin:
+            postmix.copy_ig_event(zin, zout, 'Events/Run_1/Event_1')
+            postmix.copy_ig_event(zin, zout, 'Events/Run_1/Event_2')
+        with zipfile.ZipFile(streamed_igfile) as zin:
+            assert zin.getinfo('Events/Run_1/Event_3').flag_bits & 0x08
+            postmix.copy_ig_event(zin, zout, 'Events/Run_1/Event_3')
+
+    names = ['Events/Run_1/Event_1', 'Events/Run_1/Event_2', 'Events/Run_1/Event_3']
+    with zipfile.ZipFile(tmp_path / 'out.ig') as z:
+        assert z.testzip() is None
+        assert z.namelist() == names
+        assert [json.loads(z.read(name))['event'] for name in names] == [1, 2, 3]
+        assert z.read('Events/Run_1/Event_1') == json.dumps(ig_event(1)).encode()
+        assert all(info.compress_type == zipfile.ZIP_DEFLATED for info in z.infolist())
+
+
+def test_copy_ig_event_with_transform(tmp_path, source_igfile):
+    with zipfile.ZipFile(source_igfile) as zin:
+        with zipfile.ZipFile(tmp_path / 'out.ig', 'w', compression=zipfile.ZIP_DEFLATED) as zout:
+            postmix.copy_ig_event(zin, zout, 'Events/Run_1/Event_2', lambda event: dict(event, mixed=True))
+
+    with zipfile.ZipFile(tmp_path / 'out.ig') as z:
+        assert json.loads(z.read('Events/Run_1/Event_2'))['mixed']
+
+
+def write_igfile(igfile, events):
+    with zipfile.ZipFile(igfile, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr('Header', '{}')
+        for run, event in events:
+            z.writestr(f'Events/Run_{run}/Event_{event}', json.dumps(ig_event(event)))
+
+
+def test_load_ig_index(tmp_path):
+    dfolder = tmp_path / 'igfiles'
+    dfolder.mkdir()
+    write_igfile(dfolder / 'a.ig', [(1, 1), (1, 2)])
+    write_igfile(dfolder / 'b.ig', [(2, 3)])
+    index_path = str(tmp_path / 'igfile_index.json')
+
+    event_lookup = postmix.load_ig_index([f'{dfolder}/'], index_path)
+    assert event_lookup == {(f'{dfolder}/', 1, 1): (f'{dfolder}/a.ig', 'Events/Run_1/Event_1'),
+                            (f'{dfolder}/', 1, 2): (f'{dfolder}/a.ig', 'Events/Run_1/Event_2'),
+                            (f'{dfolder}/', 2, 3): (f'{dfolder}/b.ig', 'Events/Run_2/Event_3')}
+    assert postmix.find_event_in_igfiles({'run': 2, 'event': 3}, f'{dfolder}/', event_lookup)[0] == f'{dfolder}/b.ig'
+    assert postmix.find_event_in_igfiles({'run': 2, 'event': 4}, f'{dfolder}/', event_lookup) == (None, None)
+
+    # Entries of unchanged files are read from the index, a marker event shows they are not listed again
+    with open(index_path) as f:
+        ig_index = json.load(f)
+    ig_index[f'{dfolder}/a.ig']['events'].append([9, 9, 'Events/Run_9/Event_9'])
+    with open(index_path, 'w') as f:
+        json.dump(ig_index, f)
+    write_igfile(dfolder / 'b.ig', [(2, 4), (2, 5)])
+
+    event_lookup = postmix.load_ig_index([f'{dfolder}/'], index_path)
+    assert sorted(key[1:] for key in event_lookup) == [(1, 1), (1, 2), (2, 4), (2, 5), (9, 9)]
+
+    # Removed files are dropped from the index
+    (dfolder / 'b.ig').unlink()
+    event_lookup = postmix.load_ig_index([f'{dfolder}/'], index_path)
+    with open(index_path) as f:
+        assert list(json.load(f)) == [f'{dfolder}/a.ig']
+
+
+@pytest.fixture
+def background_folder(tmp_path):
+    bkgfolder = tmp_path / 'background'
+    bkgfolder.mkdir()
+    write_igfile(bkgfolder / 'b.ig', [(3, 30), (3, 31)])
+    write_igfile(bkgfolder / 'a.ig', [(2, 20), (2, 21), (2, 22)])
+    return f'{bkgfolder}/'
+
+
+def test_background_set(background_folder):
+    bkgset = postmix.BackgroundSet(background_folder)
+    assert bkgset.get_bkg_len() == 5
+    assert bkgset.bkgeventrefs[:2] == [(f'{background_folder}a.ig', 'Events/Run_2/Event_20'),
+                                       (f'{background_folder}a.ig', 'Events/Run_2/Event_21')]
+
+    # Events are read only when they are used
+    assert bkgset.get_next_background_ref() == (f'{background_folder}a.ig', 'Events/Run_2/Event_20')
+    name, event = bkgset.get_next_background_event()
+    assert name == 'Events/Run_2/Event_21'
+    assert event['event'] == 21
+    for _ in range(3):
+        bkgset.get_next_background_ref()
+    with pytest.raises(RuntimeError):
+        bkgset.get_next_background_ref()
+
+
+def test_background_set_sample(background_folder):
+    bkgeventrefs = postmix.BackgroundSet(background_folder).bkgeventrefs
+    sampled = postmix.BackgroundSet(background_folder, sample=True, seed=2016).bkgeventrefs
+    assert sorted(sampled) == bkgeventrefs
+    assert postmix.BackgroundSet(background_folder, sample=True, seed=2016).bkgeventrefs == sampled
+
+
+def make_sets(outdir, source_igfile, background_folder, workers):
+    outdir.mkdir()
+    (outdir / 'mixedigfiles').mkdir()
+    os.chdir(outdir)
+    signal = [{'run': 1, 'event': event, 'file': str(source_igfile), 'member': f'Events/Run_1/Event_{event}'}
+              for event in [1, 2]]
+    background = {'file': 'background'}
+    shuffled_events = [background, signal[0], background, background, signal[1], background]
+    postmix.make_shuffled_ig_sets(shuffled_events, 2, 3, postmix.BackgroundSet(background_folder), workers=workers)
+    return {path.name: path.read_bytes() for path in (outdir / 'mixedigfiles').iterdir()}
+
+
+def test_make_shuffled_ig_sets(tmp_path, source_igfile, background_folder, monkeypatch):
+    # The sets are written to ./mixedigfiles
+    monkeypatch.chdir(tmp_path)
+    outputs = make_sets(tmp_path / 'parallel', source_igfile, background_folder, workers=2)
+    assert sorted(outputs) == ['event_info_0.json', 'event_info_1.json', 'fourlepton_0.ig', 'fourlepton_1.ig']
+
+    # The background events are handed out in set order, whichever worker finishes first
+    with zipfile.ZipFile(tmp_path / 'parallel' / 'mixedigfiles' / 'fourlepton_0.ig') as z:
+        assert z.namelist() == ['Events/Run_2/Event_20', 'Events/Run_1/Event_1', 'Events/Run_2/Event_21']
+    with zipfile.ZipFile(tmp_path / 'parallel' / 'mixedigfiles' / 'fourlepton_1.ig') as z:
+        assert z.testzip() is None
+        assert z.namelist() == ['Events/Run_2/Event_22', 'Events/Run_1/Event_2', 'Events/Run_3/Event_30']
+
+    assert make_sets(tmp_path / 'serial', source_igfile, background_folder, workers=1) == outputs
+
+
+def test_make_unique_events_missing_event(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dfolder = tmp_path / 'igfiles'
+    dfolder.mkdir()
+    write_igfile(dfolder / 'a.ig', [(1, 1)])
+    with open(tmp_path / 'candidates.json', 'w') as f:
+        json.dump([{'run': 1, 'event': 1}, {'run': 1, 'event': 1}], f)
+    sigsets = [{'json': str(tmp_path / 'candidates.json'), 'igfiles': f'{dfolder}/'}]
+
+    unique_events = postmix.make_unique_events(sigsets)
+    assert [(event['file'], event['member']) for event in unique_events] == \
+        [(f'{dfolder}/a.ig', 'Events/Run_1/Event_1')]
+
+    with open(tmp_path / 'candidates.json', 'w') as f:
+        json.dump([{'run': 1, 'event': 1}, {'run': 1, 'event': 2}], f)
+    with pytest.raises(RuntimeError, match='Run 1 event 2'):
+        postmix.make_unique_events(sigsets)
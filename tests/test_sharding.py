@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip("ROOT")
+
+import sharding
+
+
+def test_manifest_round_trip(tmp_path):
+    assert sharding.read_manifest(str(tmp_path)) == {"shards": {}}
+
+    manifest = {"shards": {"abc": {"files": [{"path": "a.root"}], "outputs": {"4mu": ["a.root", None]}}}}
+    sharding.write_manifest(str(tmp_path), manifest)
+    assert sharding.read_manifest(str(tmp_path)) == manifest
+    assert not (tmp_path / f"{sharding.SHARD_MANIFEST}.tmp").exists()
+
+
+def test_shard_done(tmp_path, write_file):
+    channel_outputs = {"4mu": (str(tmp_path / "4mu_output.root"), str(tmp_path / "4mu_snapshot")),
+                       "4e": (str(tmp_path / "4e_output.root"), None)}
+    shard_dir = sharding.shard_dir_for(channel_outputs)
+    assert shard_dir == str(tmp_path / "4mu_output_shards")
+
+    shard_outputs = sharding.shard_outputs_for(channel_outputs, shard_dir, "abc")
+    assert shard_outputs["4mu"] == (f"{shard_dir}/4mu_output_abc.root", f"{shard_dir}/4mu_snapshot_abc")
+    assert shard_outputs["4e"] == (f"{shard_dir}/4e_output_abc.root", None)
+
+    manifest = {"shards": {}}
+    assert not sharding.shard_done(manifest, "abc")
+
+    # A shard in the manifest is only done while all its partial outputs exist
+    manifest["shards"]["abc"] = {"files": [], "outputs": shard_outputs}
+    write_file(tmp_path / "4mu_output_shards" / "4mu_output_abc.root")
+    assert not sharding.shard_done(manifest, "abc")
+    write_file(tmp_path / "4mu_output_shards" / "4e_output_abc.root")
+    assert not sharding.shard_done(manifest, "abc")
+    write_file(tmp_path / "4mu_output_shards" / "4mu_snapshot_abc.parquet")
+    assert sharding.shard_done(manifest, "abc")
+
+    # The pick events are required when the run asks for them
+    assert not sharding.shard_done(manifest, "abc", pick_events=True)
+    write_file(tmp_path / "4mu_output_shards" / "4mu_output_abc_pickevents.root")
+    write_file(tmp_path / "4mu_output_shards" / "4e_output_abc_pickevents.root")
+    assert sharding.shard_done(manifest, "abc", pick_events=True)
+
+
+
+def test_make_shards_follow_file_identity(tmp_path, write_file):
+    write_file(tmp_path / "a.root", "a")
+    write_file(tmp_path / "b.root", "b")
+    input_glob = str(tmp_path / "*.root")
+    shards = sharding.make_shards(input_glob)
+    assert len(shards) == 2
+
+    # Replacing one file renames its shard only, adding a file leaves the others unchanged
+    write_file(tmp_path / "b.root", "replaced")
+    write_file(tmp_path / "c.root", "c")
+    new_shards = sharding.make_shards(input_glob)
+    assert len(new_shards) == 3
+    assert len(set(shards) & set(new_shards)) == 1
+
+    assert len(sharding.make_shards(input_glob, files_per_shard=2)) == 2
+
+    with pytest.raises(RuntimeError):
+        sharding.make_shards(str(tmp_path / "*.missing"))
+
+
+def test_drop_stale_shards(tmp_path, write_file):
+    channel_outputs = {"4mu": (str(tmp_path / "4mu_output.root"), str(tmp_path / "4mu_snapshot"))}
+    shard_dir = sharding.shard_dir_for(channel_outputs)
+    manifest = {"shards": {}}
+    for sid in ["kept", "stale"]:
+        shard_outputs = sharding.shard_outputs_for(channel_outputs, shard_dir, sid)
+        output_file, save_snapshot_path = shard_outputs["4mu"]
+        for path in [output_file, f"{save_snapshot_path}.parquet", f"{save_snapshot_path}.json"]:
+            write_file(path)
+        manifest["shards"][sid] = {"files": [], "outputs": shard_outputs}
+
+    assert sharding.drop_stale_shards(manifest, {"kept": [], "new": []}) == ["stale"]
+    assert list(manifest["shards"]) == ["kept"]
+    assert sorted(path.name for path in (tmp_path / "4mu_output_shards").iterdir()) == \
+        ["4mu_output_kept.root", "4mu_snapshot_kept.json", "4mu_snapshot_kept.parquet"]
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+pytest.importorskip("ROOT")
+
+import selections
+import skim_cache
+
+
+def test_key_follows_matched_files(tmp_path, write_file):
+    write_file(tmp_path / "a.root", "a")
+    input_glob = str(tmp_path / "*.root")
+    key = skim_cache.skim_cache_key(input_glob, selections.MUON_HLT_PATHS)
+    assert skim_cache.skim_cache_key(input_glob, selections.MUON_HLT_PATHS) == key
+
+    write_file(tmp_path / "b.root", "b")
+    added_key = skim_cache.skim_cache_key(input_glob, selections.MUON_HLT_PATHS)
+    assert added_key != key
+
+    write_file(tmp_path / "b.root", "replaced")
+    assert skim_cache.skim_cache_key(input_glob, selections.MUON_HLT_PATHS) not in (key, added_key)
+
+    os.remove(tmp_path / "b.root")
+    assert skim_cache.skim_cache_key(input_glob, selections.MUON_HLT_PATHS) == key
+
+
+def test_key_without_matched_files(tmp_path):
+    with pytest.raises(RuntimeError):
+        skim_cache.skim_cache_key(str(tmp_path / "*.root"), selections.MUON_HLT_PATHS)
@@ -1,7 +1,10 @@
 import json
+import os
+import textwrap
 import time
 import warnings
-import numpy as np
+
+import ROOT
 
 # Decorator to measure the execution time of a function
 def time_eval(func):
@@ -15,53 +18,294 @@ def time_eval(func):
     return wrapper
 
 
-def write_event_snapshot(df, save_snapshot_path: str, cols_to_keep: list, tree_name: str = "Events"):
-
-    def convert_to_serializable(obj):
-        """Convert non-JSON-serializable objects to JSON-compatible types."""
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, (np.integer, np.floating)):
-            return obj.item()
-        elif isinstance(obj, (bytes, bytearray)):
-            try:
-                return obj.decode()
-            except Exception:
-                return str(obj)
-        elif type(obj).__name__ == 'RVec':
-            try:
-                return list(obj)
-            except Exception:
-                return str(obj)
-        elif hasattr(obj, 'item'):
-            try:
-                return obj.item()
-            except Exception:
-                return str(obj)
-        return obj
-
-    # Attempt JSON export with RVec and ndarray support
-    try:
-        arrs = df.AsNumpy(cols_to_keep)
-        if not arrs:
-            json_list = []
-        else:
-            # All arrays should have same length
-            length = len(next(iter(arrs.values())))
-            json_list = []
-            for i in range(length):
-                entry = {}
-                for col in cols_to_keep:
-                    vals = arrs.get(col)
-                    if vals is None:
-                        entry[col] = None
-                        continue
-                    v = vals[i]
-                    entry[col] = convert_to_serializable(v)
-                json_list.append(entry)
-
-        with open(f"{save_snapshot_path}.json", "w") as jf:
-            json.dump(json_list, jf, indent=2)
+class NodeProfiler:
+
+    # Per-slot timers of the Filter and Define nodes booked through a ProfiledNode,
+    # grouped by the analysis stage they belong to
+    def __init__(self, nslots: int):
+        self.nslots = nslots
+        self.nodes = []
+
+    def register(self, kind: str, name: str, stage: str) -> int:
+        node_idx = ROOT.register_node_timer(self.nslots)
+        self.nodes.append({"idx": node_idx, "kind": kind, "name": name, "stage": stage})
+        return node_idx
+
+    def report(self) -> dict:
+
+        # Read after the event loop, the timers are summed over the slots
+        nodes = []
+        stages = {}
+        for node in self.nodes:
+            calls, passed, cpu_time = ROOT.node_timer_totals(node["idx"])
+            entry = {"name": node["name"], "kind": node["kind"], "stage": node["stage"],
+                     "events_in": int(calls), "cpu_time_s": cpu_time,
+                     "time_per_event_ns": cpu_time / calls * 1e9 if calls > 0 else 0.0}
+            if node["kind"] == "Filter":
+                entry["events_out"] = int(passed)
+            nodes.append(entry)
+
+            stage = stages.setdefault(node["stage"], {"nodes": 0, "cpu_time_s": 0.0})
+            stage["nodes"] += 1
+            stage["cpu_time_s"] += cpu_time
+
+        return {"nslots": self.nslots, "stages": stages, "nodes": nodes}
+
+    def write_report(self, output_file: str):
+
+        # Written next to the histogram output, e.g. 4mu_output.root -> 4mu_output_nodes.json
+        report_path = f"{os.path.splitext(output_file)[0]}_nodes.json"
+        with open(report_path, "w") as report_f:
+            json.dump(self.report(), report_f, indent=2)
+        print(f"Successfully wrote node timing report to {report_path}")
+
+
+class ProfiledNode:
+
+    # Dataframe node whose Filter and Define expressions are wrapped in per-slot timers.
+    # Every other attribute, e.g. Histo1D or Report, is forwarded to the wrapped node
+    def __init__(self, node, profiler: NodeProfiler, stage: str = "Input"):
+        self.node = node
+        self.profiler = profiler
+        self.stage = stage
+
+    def Filter(self, selstr: str, name: str = ""):
+        node_idx = self.profiler.register("Filter", name if name else selstr, self.stage)
+        timed_selstr = f"node_count_pass({node_idx}, rdfslot_, (NodeTimerScope({node_idx}, rdfslot_), ({selstr})))"
+        return ProfiledNode(self.node.Filter(timed_selstr, name), self.profiler, self.stage)
+
+    def Define(self, name: str, expression: str):
+        node_idx = self.profiler.register("Define", name, self.stage)
+        timed_expression = f"NodeTimerScope({node_idx}, rdfslot_), ({expression})"
+        return ProfiledNode(self.node.Define(name, timed_expression), self.profiler, self.stage)
+
+    def __getattr__(self, attr):
+        return getattr(self.node, attr)
+
+
+def profile_nodes(df):
+    profiler = NodeProfiler(df.GetNSlots())
+    return ProfiledNode(df, profiler), profiler
+
+
+def raw_node(df):
+    # The dataframe node under a ProfiledNode, e.g. to pass it to C++ as an RNode
+    if isinstance(df, ProfiledNode):
+        return df.node
+    return df
+
+
+def is_distributed(df) -> bool:
+    # Nodes of the distributed RDataFrame are python proxies defined in the DistRDF package
+    return type(raw_node(df)).__module__.startswith("DistRDF")
+
+
+def set_stage(df, stage: str):
+    # Nodes booked from the returned node are reported under stage, plain nodes are returned as is
+    if isinstance(df, ProfiledNode):
+        return ProfiledNode(df.node, df.profiler, stage)
+    return df
+
+
+# Columns kept for every Higgs candidate in the event snapshots
+SNAPSHOT_COLUMNS = ["run", "luminosityBlock", "event", "fourlep_mass",
+                    "fourlep_pts", "fourlep_etas", "fourlep_phis", "fourlep_pids"]
+
+# Derived candidate columns written next to the original NanoAOD branches of the picked events
+PICK_EVENTS_COLUMNS = ["fourlep_mass", "fourlep_pts", "fourlep_etas", "fourlep_phis", "fourlep_pids"]
+PICK_EVENTS_COMPRESSION_ALGORITHM = "kLZMA"
+PICK_EVENTS_COMPRESSION_LEVEL = 8
+
+# Arrow types of the snapshot columns, every part is written with them so parts without
+# candidates can be merged with the others
+SNAPSHOT_COLUMN_TYPES = {"run": "uint32", "luminosityBlock": "uint32", "event": "uint64", "fourlep_mass": "float64",
+                         "fourlep_pts": "list<float32>", "fourlep_etas": "list<float32>",
+                         "fourlep_phis": "list<float32>", "fourlep_pids": "list<int32>"}
+
+# Candidates converted per chunk from the ROOT snapshot to Parquet and from Parquet to JSON
+SNAPSHOT_CHUNK_EVENTS = 100000
+
+# The JSON derived from the Parquet snapshot is read by combine_json and the IG tools
+SNAPSHOT_WRITE_JSON = True
+
+
+def write_histograms(histograms: list, output_file: str):
+
+    # Write the histograms to the output file
+    output_tfile = ROOT.TFile(output_file, "RECREATE")
+    for hist in histograms:
+        hist.Write()
+    output_tfile.Close()
+
+
+def print_cutflow(input_file: str, n_events, cutflow):
+
+    # Both results are booked lazily, so they are read after the event loop already ran
+    print(f"Analysed {n_events.GetValue()} events in path: {input_file}")
+    if cutflow is not None:
+        cutflow.Print()
+
+
+class EventSnapshot:
+
+    # Lazily booked candidate snapshot together with the number of candidates, so a snapshot
+    # without candidates is told apart from one that failed to be written
+    def __init__(self, result, n_entries):
+        self.result = result
+        self.n_entries = n_entries
+
+    def GetValue(self):
+        return self.result.GetValue()
+
+
+def book_event_snapshot(df, save_snapshot_path: str, cols_to_keep: list) -> EventSnapshot:
+
+    # Lazily booked, so the candidates are streamed to <save_snapshot_path>.root in the same
+    # event loop as the histograms. The distributed backends collect the columns instead
+    if is_distributed(df):
+        return EventSnapshot(df.AsNumpy(cols_to_keep, lazy=True), df.Count())
+    options = ROOT.RDF.RSnapshotOptions()
+    options.fLazy = True
+    return EventSnapshot(df.Snapshot("Events", f"{save_snapshot_path}.root", cols_to_keep, options), df.Count())
+
+
+def pick_events_path(output_file: str) -> str:
+    # Written next to the histogram output, e.g. 4mu_output.root -> 4mu_output_pickevents.root
+    return f"{os.path.splitext(output_file)[0]}_pickevents.root"
+
+
+def book_pick_events(df, output_file: str, derived_cols: list = PICK_EVENTS_COLUMNS):
+
+    # Every original NanoAOD branch of the candidate events plus the derived candidate columns,
+    # lazily booked so they are written in the same event loop as the histograms
+    if is_distributed(df):
+        warnings.warn("Pick events are only written for local runs")
+        return None
+    node = raw_node(df)
+    defined_cols = set(str(col) for col in node.GetDefinedColumnNames())
+    columns = [str(col) for col in node.GetColumnNames() if str(col) not in defined_cols and not str(col).startswith("#")]
+
+    options = ROOT.RDF.RSnapshotOptions()
+    options.fLazy = True
+    options.fCompressionAlgorithm = getattr(ROOT.RCompressionSetting.EAlgorithm, PICK_EVENTS_COMPRESSION_ALGORITHM)
+    options.fCompressionLevel = PICK_EVENTS_COMPRESSION_LEVEL
+    return node.Snapshot("Events", pick_events_path(output_file), columns + derived_cols, options)
+
+
+def write_pick_events(picked, output_file: str):
+    # The event loop already ran for the histograms, this only reports the written file
+    picked.GetValue()
+    print(f"Successfully wrote picked events to {pick_events_path(output_file)}")
+
+
+def snapshot_schema(cols_to_keep: list):
+
+    import pyarrow as pa
+
+    def arrow_type(type_name: str):
+        if type_name.startswith("list<"):
+            return pa.list_(arrow_type(type_name[len("list<"):-1]))
+        return pa.type_for_alias(type_name)
+
+    return pa.schema([(col, arrow_type(SNAPSHOT_COLUMN_TYPES[col])) for col in cols_to_keep])
+
+
+def snapshot_to_parquet(snapshot: EventSnapshot, save_snapshot_path: str, cols_to_keep: list):
+
+    import awkward as ak
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import uproot
+
+    schema = snapshot_schema(cols_to_keep)
+    root_path = f"{save_snapshot_path}.root"
+
+    # Without candidates the ROOT file can lack the Events tree, the part is written empty
+    # with the column types so it is still merged with the others
+    arrs = snapshot.GetValue()
+    if snapshot.n_entries.GetValue() == 0:
+        pq.write_table(schema.empty_table(), f"{save_snapshot_path}.parquet")
+        if os.path.exists(root_path):
+            os.remove(root_path)
+        return
+
+    # Collected columns of a distributed run, the vector columns become list columns
+    if isinstance(arrs, dict):
+        table = pa.table({col: [list(v) for v in arrs[col]] if arrs[col].dtype == object else arrs[col]
+                          for col in cols_to_keep}, schema=schema)
+        pq.write_table(table, f"{save_snapshot_path}.parquet")
+        return
+
+    # The ROOT snapshot is converted chunk by chunk, so the memory is bounded by the chunk size
+    with uproot.open(root_path) as root_f, pq.ParquetWriter(f"{save_snapshot_path}.parquet", schema) as writer:
+        for chunk in root_f["Events"].iterate(cols_to_keep, step_size=SNAPSHOT_CHUNK_EVENTS, library="ak"):
+            writer.write_table(ak.to_arrow_table(chunk, extensionarray=False).cast(schema))
+    os.remove(root_path)
+
+
+def parquet_to_json(save_snapshot_path: str):
+
+    import pyarrow.parquet as pq
+
+    # Same layout as json.dump(candidates, indent=2), written one chunk of candidates at a time
+    with open(f"{save_snapshot_path}.json", "w") as jf:
+        n_entries = 0
+        for batch in pq.ParquetFile(f"{save_snapshot_path}.parquet").iter_batches(batch_size=SNAPSHOT_CHUNK_EVENTS):
+            for entry in batch.to_pylist():
+                jf.write(",\n" if n_entries > 0 else "[\n")
+                jf.write(textwrap.indent(json.dumps(entry, indent=2), "  "))
+                n_entries += 1
+        jf.write("\n]" if n_entries > 0 else "[]")
+
+
+def write_event_snapshot(snapshot: EventSnapshot, save_snapshot_path: str, cols_to_keep: list,
+                         write_json: bool = SNAPSHOT_WRITE_JSON):
+
+    # snapshot is booked with book_event_snapshot, the Parquet file keeps the full float precision.
+    # Failures are raised, so a run whose snapshot was not written is not taken as complete
+    snapshot_to_parquet(snapshot, save_snapshot_path, cols_to_keep)
+    print(f"Successfully wrote event snapshot to {save_snapshot_path}.parquet")
+    if write_json:
+        parquet_to_json(save_snapshot_path)
         print(f"Successfully wrote event snapshot to {save_snapshot_path}.json")
-    except Exception as e:
-        warnings.warn(f"Failed to write JSON snapshot ({save_snapshot_path}.json): {e}")
\ No newline at end of file
+
+
+def merge_event_snapshots(part_paths: list, save_snapshot_path: str, remove_parts: bool = True,
+                          write_json: bool = SNAPSHOT_WRITE_JSON):
+
+    import pyarrow.parquet as pq
+
+    # Concatenates the snapshots written per part, in the order of the parts. Parts without
+    # candidates are skipped, the schema is taken from the first part with candidates. Every
+    # part is written even without candidates, so a missing one means lost candidates
+    missing = [f"{part_path}.parquet" for part_path in part_paths if not os.path.exists(f"{part_path}.parquet")]
+    if missing:
+        raise FileNotFoundError(f"Snapshot parts not found: {', '.join(missing)}")
+
+    writer = None
+    empty_part_f = None
+    for part_path in part_paths:
+        part_f = pq.ParquetFile(f"{part_path}.parquet")
+        if part_f.metadata.num_rows == 0:
+            empty_part_f = empty_part_f or part_f
+            continue
+        if writer is None:
+            writer = pq.ParquetWriter(f"{save_snapshot_path}.parquet", part_f.schema_arrow)
+        for batch in part_f.iter_batches(batch_size=SNAPSHOT_CHUNK_EVENTS):
+            writer.write_batch(batch)
+    if writer is None and empty_part_f is None:
+        warnings.warn(f"No snapshot parts found for {save_snapshot_path}")
+        return
+    if writer is None:
+        pq.write_table(empty_part_f.schema_arrow.empty_table(), f"{save_snapshot_path}.parquet")
+    else:
+        writer.close()
+
+    if remove_parts:
+        for part_path in part_paths:
+            for extension in [".parquet", ".json"]:
+                if os.path.exists(f"{part_path}{extension}"):
+                    os.remove(f"{part_path}{extension}")
+    if write_json:
+        parquet_to_json(save_snapshot_path)
+    print(f"Successfully merged {len(part_paths)} event snapshots into {save_snapshot_path}.parquet")